@@ -3,6 +3,7 @@
 from __future__ import annotations  # NOTE: what does this actually do?
 import os
 import sys
+import asyncio
 import logging
 import logging.config
 logging.config.fileConfig(fname='logging.ini', disable_existing_loggers=False)
@@ -19,8 +20,21 @@ try:
 except RuntimeError as e:
     logger.error("not using bytes_as_braille ({e})")
 from collections import deque
-from time import sleep
+from time import monotonic, monotonic_ns
+from functools import partial
 from proghelp import *
+from gcode_compile import load_or_compile, CompiledLines, SUFFIX
+from gcode_source import MappedLines
+from resend_window import ResendWindow
+import marlin_replies
+from marlin_replies import Ack, Temperature, Position, Busy, Wait, UnknownCommand, Echo, Comment, Resend
+from serial_aio import open_serial_connection
+from chunked_seq import ChunkedSequence
+from ack_history import AckHistory, AckRecord, status_code, format_ns
+from search_index import CommandIndex
+from credit import AdaptiveWindow
+from interleave import ZInterleaver
+from macros import Macros, MacroError
 
 EXTRA_DEBUG = False
 
@@ -31,7 +45,6 @@ TODOs:
 
 * implement replies to
 - !! / Error: / fatal:
-- rs / Resend
 - busy:<reason>
 in general: https://reprap.org/wiki/G-code#Replies_from_the_RepRap_machine_to_the_host_computer
 https://reprap.org/wiki/G-code#Action_commands
@@ -46,10 +59,8 @@ https://reprap.org/wiki/G-code#Action_commands
 * automatically extract and cache G-Code command usage from https://raw.githubusercontent.com/MarlinFirmware/MarlinDocumentation/master/_gcode/ and list of commands when compiling firmware (requires Marlin patch)
 * don't hang waiting for the printer to reply something when a lot of commands are in the pile! (`force` ; must be fixed)
 * multiple gcode files on cmd line
-* parallel G-Code with z-based interpolation, partial cancel
 * display commands number (for history) ; don't consider comments and status messages as commands
 * better coloring in piles ; color command in progress (the one on "top" of WIP pile)
-* don't redraw all internal widgets?
 * mouse control with XY, XZ, YZ plane selection and position reporting (mouse or from serial device)
 * full power is 127%... not cool XD ; honor MAX_BED_POWER (must be set in config, if possible automatically when compiling firmware)
 * it turns out this entire thing is quite slow... on small segments the printer will stutter, we are no way near the 1MBPs on the serial connection.
@@ -60,17 +71,22 @@ Weird:
 - Marlin ommits 'C:' prefix to coordinates?
 """
 
-loop, wai_pile, wip_pile, ack_pile, edit, machine_pos, messages, tbars, info_dic, machine_status, gcode_piles, watch_pipe, div, cmd_pile, all_wai, editmap = [None for _ in range(16)]
+loop, wai_pile, wip_pile, ack_pile, edit, machine_pos, messages, tbars, info_dic, machine_status, gcode_piles, event_loop, div, cmd_pile, all_wai, editmap, redraw, interleaver = [None for _ in range(18)]
+# line numbers, checksums and resends (--checksum)
+LINES = None
 PRINT_PAUSED = True
-MAX_COMMANDS_IN_WIP = 5#12  # TODO exclude comments from this count!
+# initial number of commands in flight, adapted to the `ok` replies (see credit.AdaptiveWindow)
+MAX_COMMANDS_IN_WIP = 5
 # max lines to show in piles
 DISP_ACK_LEN = 30
 DISP_WAI_LEN = 10
+# maximum screen refresh rate
+MAX_FPS = 20
+# drawing the screen shares the loop with serial I/O: slow down the refresh rate if it takes more than this share of the time
+MAX_DRAW_SHARE = .25
 
 # exceptions and error messages:
-class GotTempReport(Exception): pass
 class FormatError(Exception): pass
-watch_pipe_error = (urwid.Text(('error','OSError on watch_pipe ; display refresh will suffer')), ('pack',None))
 
 import pendulum
 TIME_FMT = "%Y-%m-%d %H:%M:%S"
@@ -79,6 +95,68 @@ TIME_LEN = len(pendulum.now().strftime(TIME_FMT))+1
 
 # the list of commands that the machine supports ; populated later
 valid_commands = {}
+# `macro=` lines of the machine config (see macros.py)
+macros = Macros()
+
+class RedrawScheduler:
+    """
+        coalesces screen updates and repaints at most `fps` times per second
+
+        whatever changes what must be shown calls `mark(key, update)` ;
+        `update` is a callable that changes the widgets, only the last one per
+        key is kept and they all run in the next frame, which is then drawn.
+
+        frames are further apart when drawing them takes more than
+        MAX_DRAW_SHARE of the time, the serial link gets the rest.
+    """
+    def __init__(self, fps = MAX_FPS):
+        self.interval = 1/fps
+        self.updates = {}
+        self.scheduled = False
+        self.last_frame = 0
+        # how long the last frame took to draw
+        self.cost = 0
+        self.frames = 0
+
+    def __str__(self):
+        return f"<RedrawScheduler: {1/self.interval:g} fps max, {self.frames} frames, {self.cost*1000:.1f} ms/frame, {len(self.updates)} pending>"
+
+    def mark(self, key, update):
+        self.updates[key] = update
+        if self.scheduled or loop is None:
+            return
+        self.scheduled = True
+        interval = max(self.interval, self.cost/MAX_DRAW_SHARE)
+        loop.set_alarm_in(max(self.last_frame+interval-monotonic(), 0), self.frame)
+
+    def frame(self, *args):
+        updates, self.updates = self.updates, {}
+        self.scheduled = False
+        for update in updates.values():
+            update()
+        start = monotonic()
+        loop.draw_screen()
+        self.last_frame = monotonic()
+        self.cost = self.last_frame-start
+        self.frames += 1
+
+# new messages (newest first) until the next frame
+MESSAGES = deque()
+
+def message(text, style = ''):
+    """ shows `text` on top of the messages panel """
+    MESSAGES.appendleft( urwid.Text((style, text)) )
+    redraw.mark(messages, flush_messages)
+
+def flush_messages():
+    new = []
+    while MESSAGES:
+        new.append( (MESSAGES.popleft(), ('pack',None)) )
+    messages.contents = [ *new, *messages.contents ]
+
+def set_status(style):
+    """ colors the machine name according to the connection status """
+    redraw.mark(machine_status, lambda: machine_status.set_text((style, machine_status.get_text()[0])))
 
 class WQueue:
     """
@@ -86,11 +164,20 @@ class WQueue:
 
         basically a list, and a viewport on that list
 
-        override `widget` and `subwidget` if your UI differs from urwid
+        the list is a ChunkedSequence: inserting, deleting or looking up a
+        command anywhere in a pile is O(log n), even for a whole G-Code file.
+
+        the widget is built once and its row widgets are recycled: `refresh`
+        only updates the rows whose item changed and, when the viewport
+        scrolls, moves the rows that went out of view to the other end instead
+        of building new ones, so a redraw costs what changed, not the size of
+        the viewport.
+
+        override `cells` (and `subwidget`, `recycle`) if your UI differs from urwid
     """
     def __init__(self, name, content = [], **kwargs ):
         self.name = name
-        self.content = deque(content)
+        self.content = ChunkedSequence(content)
         self.display_size = kwargs.pop('display_size', 10)
         self.paused = kwargs.pop('paused', True)
         self.style = kwargs.pop('style', 'qTitle')
@@ -98,53 +185,102 @@ class WQueue:
         self.max_content_len = kwargs.pop('max_content_len', -1)
         self.color = kwargs.pop('color', 'wait')
         self.viewport_start = kwargs.pop('viewport_start', -1 )
+        self._pile = urwid.Pile( [ urwid.Text( (self.style, self.name) ) ] if self.show_title else [] )
+        # the displayed rows: [item, widget, layout]
+        self._rows = []
 
     def __str__(self):
         return f"<WQueue: {self.name} ({len(self.content)} lines)>"
 
-    def subwidget(self, text, *args, **kwargs):
-        return urwid.Text( self.linecolor(text), *args, **kwargs)
-    
+    def cells(self, item):
+        """ the row for `item`: a list of (width, text markup), width is None for a flexible column """
+        return [ (None, self.linecolor(item)) ]
+
+    def subwidget(self, item):
+        """ a new row widget for `item`: [item, widget, layout] """
+        cells = self.cells(item)
+        layout = tuple( width for width, _ in cells )
+        if layout == (None,):
+            return [ item, urwid.Text( cells[0][1] ), layout ]
+        return [ item, urwid.Columns([ urwid.Text(text) if width is None else (width, urwid.Text(text)) for width, text in cells ]), layout ]
+
+    def recycle(self, row, item):
+        """ shows `item` in an existing row widget, False if the row doesn't have the right layout """
+        cells = self.cells(item)
+        if tuple( width for width, _ in cells ) != row[2]:
+            return False
+        texts = [ row[1] ] if row[2] == (None,) else [ w for w, _ in row[1].contents ]
+        for text, (_, markup) in zip(texts, cells):
+            text.set_text(markup)
+        row[0] = item
+        return True
+
+    def visible(self):
+        """ the items in the viewport """
+        if self.viewport_start == -1:
+            return self.content[-self.display_size:]
+        return self.content[self.viewport_start:self.viewport_start+self.display_size]
+
+    def refresh(self):
+        """ brings the widget up to date with the content, returns it """
+        items = self.visible()
+        rows = self._rows
+        contents = self._pile.contents
+        top = 1 if self.show_title else 0
+
+        # items are compared by identity: how many rows scrolled out at the top?
+        shift = next( (k for k, row in enumerate(rows) if items and row[0] is items[0]), len(rows) )
+        if 0 < shift < len(rows):
+            moved = contents[top:top+shift]
+            del contents[top:top+shift]
+            contents.extend(moved)
+            rows[:] = rows[shift:] + rows[:shift]
+
+        for i, item in enumerate(items):
+            if i == len(rows):
+                rows.append( self.subwidget(item) )
+                contents.append( (rows[i][1], self._pile.options()) )
+            elif rows[i][0] is not item and not self.recycle(rows[i], item):
+                rows[i] = self.subwidget(item)
+                contents[top+i] = (rows[i][1], self._pile.options())
+        if len(rows) > len(items):
+            del contents[top+len(items):]
+            del rows[len(items):]
+        return self._pile
+
     @property
-    def widget(self, preload = []):
-        if len(self.content) < self.display_size:
-            if self.show_title:
-                return urwid.Pile( [ urwid.Text( (self.style, self.name) ), *preload, *[ self.subwidget(tup) for tup in self.content ]] )
-            else:
-                return urwid.Pile( [*preload, *[ self.subwidget(tup) for tup in self.content ]] )
-        else:
-            if self.show_title:
-                if self.viewport_start == -1:
-                    return urwid.Pile( [ urwid.Text( (self.style, self.name) ), *preload, *[ self.subwidget(self.content[-self.display_size+i]) for i in range(self.display_size) ]] )
-                else:
-                    return urwid.Pile( [ urwid.Text( (self.style, self.name) ), *preload, *[ self.subwidget(self.content[self.viewport_start+i]) for i in range(self.display_size) ]] )
-            else:
-                if self.viewport_start == -1:
-                    return urwid.Pile( [ *preload, [ self.subwidget(self.content[-self.display_size+i]) for i in range(self.display_size) ]] )
-                else:
-                    return urwid.Pile( [ *preload, [ self.subwidget(self.content[self.viewport_start+i]) for i in range(self.display_size) ]] )
+    def widget(self):
+        return self.refresh()
 
     def append(self, item, pos = -1):
+        """ appends `item`, or inserts it at the top (`pos` 0) or after position `pos` """
         if pos == -1:
             self.content.append(item)
         elif pos == 0:
-            # NOTE only works if self.content was declared as collections.deque() !
             self.content.appendleft(item)
         else:
-            self.content = [ *self.content[:pos+1],  item, *self.content[pos+1:] ]
+            self.content.insert(pos+1, item)
+        self.dirty()
 
     def pop(self, pos):
-        # deque.rotate() is speedy
-        self.content.rotate(-pos)
-        #try:
-        item = self.content.popleft()
-        #except IndexError as e:
-        #    logger.info(f"queue was empty! [0]")
-        #    #raise
-        #else:
-        self.content.rotate(pos)
+        item = self.content.popleft() if pos == 0 else self.content.pop(pos)
+        self.dirty()
         return item
 
+    def scroll(self, lines):
+        """ moves the viewport `lines` down (or up if negative) ; it follows the end of the pile again once it gets there """
+        last = max(len(self.content)-self.display_size, 0)
+        start = last if self.viewport_start == -1 else self.viewport_start
+        self.viewport_start = min(max(start+lines, 0), last)
+        if self.viewport_start == last:
+            self.viewport_start = -1
+        self.dirty()
+
+    def dirty(self):
+        """ the widget will be refreshed on the next frame (see RedrawScheduler) """
+        if redraw is not None:
+            redraw.mark(self, self.refresh)
+
     def __len__(self):
         return len(self.content)
 
@@ -168,53 +304,54 @@ class WQueue:
 
 
 class ACKPile(WQueue):
-    def subwidget(self, *args, **kwargs):
-        if len((tup := args[0])) == 2:
-            if tup[0] is not None:
-                try:
-                    if type(tup[0]) is pendulum.DateTime:
-                        return urwid.Columns([urwid.Text(f"OOPS: {tup[0]}")])
-                    return urwid.Columns([
-                            (TIME_LEN, urwid.Text( ('timestamp', tup[0][0].strftime(TIME_FMT)) )),
-                            urwid.Text( tup[0][1] ),
-                            urwid.Text( tup[1][1] ),
-                            (TIME_LEN, urwid.Text( ('timestamp', tup[1][0].strftime(TIME_FMT)) )),
-                        ])
-                except IndexError:
-                    logger.info(f"IndexError ; full ACK message {tup[0]} --- {tup[1]}")
-                    raise
-                except TypeError:
-                    logger.info(f"TypError ; full ACK message {tup[0]} --- {tup[1]}")
-                    raise
-            else:
-                #logger.debug(f"no-ACK message {tup[0]} --- {tup[1]}")
-                return urwid.Columns([
-                        (TIME_LEN, urwid.Text( '' )),
-                        #urwid.Text( self.linecolor( tup[1][1] )),
-                        urwid.Text( tup[1][1] ),
-                        (TIME_LEN, urwid.Text( ('timestamp', tup[1][0].strftime(TIME_FMT)) )),
-                    ])
-        else:
-            #logger.info(f"short ACK message {tup[0][0]} --- {tup[0][1]}")
-            return urwid.Columns([
-                    (TIME_LEN, urwid.Text( ('timestamp', tup[0][0].strftime(TIME_FMT)) )),
-                    urwid.Text( tup[0][1] ),
-                ])
+    """
+        what the machine acknowledged, as a bounded AckHistory (see ack_history.py)
+
+        items are (WIP item, (status, reply)) ; the WIP item is None for
+        messages from the machine, the reply is None for comments that were
+        not sent
+    """
+    def __init__(self, name, content = [], ring = 4096, spill = None, **kwargs):
+        super().__init__(name, **kwargs)
+        self.content = AckHistory(ring, spill)
+        for item in content:
+            self.content.append(self.record(item))
+
+    def record(self, item):
+        sent, command = (None, None) if item[0] is None else item[0]
+        status, reply = (None, None) if item[1] is None else item[1]
+        return AckRecord(sent, monotonic_ns(), status_code(status), command, reply)
+
+    def cells(self, record):
+        if record.command is None:
+            return [
+                    (TIME_LEN, '' ),
+                    (None, record.markup() ),
+                    (TIME_LEN, ('timestamp', format_ns(record.acked, TIME_FMT)) ),
+                ]
+        return [
+                (TIME_LEN, ('timestamp', format_ns(record.sent, TIME_FMT)) ),
+                (None, record.command ),
+                (None, record.markup() ),
+                (TIME_LEN, ('timestamp', format_ns(record.acked, TIME_FMT)) ),
+            ]
 
     def append(self, item, where = None):
-        now = pendulum.now()
         if where:
-            logger.debug(f"ACK: appending {(item[0], (now), item[1])} ({where})")
-        self.content.append( (item[0], (now, item[1])) )
+            logger.debug(f"ACK: appending {item} ({where})")
+        self.content.append(self.record(item))
+        self.dirty()
         # TODO add machines names?
         #case 'greeter':
         #    result.critical(f"{now}: Gwiz started")  
         try:
-            if item[1][1].startswith(b'ok'):
+            if item[1] is None:
+                # a comment we sent? don't need to over-commment
+                result.warning(item[0][1].decode())
+            elif item[1][1].startswith(b'ok'):
                 result.error(item[0][1].decode())
             elif item[0] is None:
                 if item[1][1].startswith(b';'):
-                    # this maybe a comment we sent? don't need to over-commment
                     result.warning(item[1][1].decode())
                 elif item[1][0] in ('status_msg',):
                     # communication from printer ; can't be replayed as-is in gcode so we double-comment it
@@ -234,25 +371,71 @@ class ACKPile(WQueue):
             logger.critical(f"{e} (FK582H5H): {item}")
 
 
+def is_command(cmd):
+    """ False for comments and blank lines, which are never sent """
+    cmd = cmd.strip()
+    return len(cmd) > 0 and not cmd.startswith(b';')
+
 class WIPPile(WQueue):
-    def subwidget(self, *args, **kwargs):
-        return urwid.Columns([
-                ( TIME_LEN, urwid.Text( ('timestamp', args[0][0].strftime(TIME_FMT)) )),
-                urwid.Text( self.linecolor( args[0][1], kwargs.pop('color', self.color) )),
-            ])
+    """
+        what was sent to the machine and not acknowledged yet, (timestamp, command)
+
+        the pile is saturated when the commands it holds (comments don't count)
+        reach the in-flight window, which adapts to the machine's replies
+    """
+    def __init__(self, name, content = [], window = None, **kwargs):
+        super().__init__(name, content, **kwargs)
+        self.window = AdaptiveWindow(MAX_COMMANDS_IN_WIP) if window is None else window
+        self.commands = 0
 
-    #def widget(self):
-    #    return super().widget()
+    def cells(self, item):
+        return [
+                ( TIME_LEN, ('timestamp', format_ns(item[0], TIME_FMT)) ),
+                ( None, self.linecolor( item[1] )),
+            ]
 
     def append(self, item, where = None):
         if where:
-            logger.debug(f"WIP: appending {(pendulum.now(), item)} ({where})")
+            logger.debug(f"WIP: appending {item} ({where})")
         try:
             if self.content[0][1].startswith(b';'):
-                ack_pile.append( (None,wip_pile.pop(0)) )
+                ack_pile.append( (wip_pile.pop(0), None) )
         except IndexError:
             pass
-        self.content.append( (pendulum.now(), item) )
+        self.content.append( (monotonic_ns(), item) )
+        if is_command(item):
+            self.commands += 1
+        self.dirty()
+
+    def pop(self, pos):
+        item = super().pop(pos)
+        if is_command(item[1]):
+            self.commands -= 1
+        return item
+
+    @property
+    def is_saturated(self):
+        return self.commands >= self.window.window
+
+
+
+class FilePile(WQueue):
+    """
+        a G-Code file, read lazily
+
+        `lines` is a sequence over the memory-mapped file (MappedLines, or
+        CompiledLines for a compiled file) that is consumed from the head ; only
+        the lines in the viewport and the ones being sent are ever loaded.
+    """
+    def __init__(self, name, lines, **kwargs):
+        super().__init__(name, **kwargs)
+        self.content = lines
+        if hasattr(lines, 'on_progress'):
+            # the file is still being indexed (in a thread)
+            lines.on_progress = lambda: event_loop.call_soon_threadsafe(self.dirty)
+
+    def __str__(self):
+        return f"<FilePile: {self.name} ({self.content})>"
 
 
 
@@ -278,8 +461,8 @@ def pop_to_serial(s, pile):
         #        return
 
     # strip comments and invalid commands
-    if not cmd.strip().startswith(b';') and not cmd.isspace() and len(cmd) > 0:
-        s.write((cmd+b'\n'))
+    if is_command(cmd):
+        s.write(cmd+b'\n' if LINES is None else LINES.frame(cmd.split(b';',1)[0].strip()))
         if EXTRA_DEBUG: logger.debug(f">>> {cmd}")
 
 
@@ -288,9 +471,11 @@ def pop_to_serial(s, pile):
 
     TODO add some formatting and timestamps
 """
-def read_from_serial(s):
+async def read_from_serial(ser):
     do_update_ack = None
     cmd_errors = deque()
+    # the 'ok' that follows a resend request belongs to the rejected line, which is still in the WIP pile
+    skip_acks = 0
 
     # NOTE this depends on firmware and 
     # it makes GWiz wait for a 'start' from the printer
@@ -308,173 +493,136 @@ def read_from_serial(s):
     #   kept for reference.
 
     try:
+        s = await open_serial_connection(ser)
         while True:
-            reply = s.readline().rstrip(b'\n')
+            event = marlin_replies.parse(await s.readline())
+            reply = event.line
             if EXTRA_DEBUG: logger.debug(f"<<< {reply}")
-            try:
-                if reply.startswith(b'ok'):
+            match event:
+                case Ack(P=P, B=B, temperature=temperature):
+                    latency = None
                     skip = False
-                    while True:
+                    if skip_acks:
+                        skip_acks -= 1
+                        skip = True
+                    while not skip:
                         try:
                             if (last_wip_command_with_ts := wip_pile.pop(0))[1].startswith(b';'):
-                                ack_pile.append( last_wip_command_with_ts, '0' )
+                                ack_pile.append( (last_wip_command_with_ts, None), '0' )
                             else:
                                 break
-                        #except TypeError:
-                        #    logger.info(f"read_from_serial(): queue was empty! [1] {reply}")
-                        #    #raise
-                        #    break
                         except IndexError:
                             logger.info(f"read_from_serial(): received '{reply}' but queue was empty")
                             skip = True
                             break
                             
                     if not skip:
-                        try:
-                            if last_wip_command_with_ts[1] == cmd_errors[0]:
-                                ack_pile.append( (last_wip_command_with_ts, ('error','Unknown command') ), '1')
-                                cmd_errors.popleft()
-                            else:
-                                raise IndexError
-                        except IndexError:
+                        latency = (monotonic_ns()-last_wip_command_with_ts[0])/1e9
+                        if cmd_errors and last_wip_command_with_ts[1] == cmd_errors[0]:
+                            ack_pile.append( (last_wip_command_with_ts, ('error','Unknown command') ), '1')
+                            cmd_errors.popleft()
+                        else:
                             # normal command here, nothing special
                             # TODO it would be nice to split and color trailing comments
-                            #logger.info('whoops', last_wip_command_with_ts)
                             ack_pile.append( (last_wip_command_with_ts, ('ack_msg',reply)), '2' )
                             # TODO update position if last command is one of G0-G5 ?
-                    #except TypeError:
-                    #    logger.info("read_from_serial(): queue was empty! [2]")
-                    #    #raise
-                        
-
-                    if reply.startswith(b'ok T:'):
-                        reply = reply[2:]
-                        raise GotTempReport
+
+                    wip_pile.window.ack(P, B, latency, streaming=not PRINT_PAUSED)
+                    if temperature is not None:
+                        show_temperatures(temperature)
                     # else: TODO throttling and "skip" in cas of missed ACK message
                     # see also https://reprap.org/wiki/GCODE_buffer_multiline_proposal
-                elif reply in [b'wait',b'echo:busy: processing']:
+                case Wait() | Busy(reason=b'processing'):
                     # ignore this shit, we don't need that as a "clock" XD
                     # see HOST_KEEPALIVE_FEATURE DEFAULT_KEEPALIVE_INTERVAL BUSY_WHILE_HEATING NO_TIMEOUTS
                     MACHINE_READY = True
-                    #logger.error(f"{reply}")
-                    pass
-                elif reply.startswith(b'X:'):
-                    machine_pos.set_text(reply.split(b' Count ',1)[0])
-                elif reply.startswith(b' T:'):
-                    raise GotTempReport
-                elif reply.startswith(b'echo:'):
-                    if reply.startswith(b'echo:Unknown command:'):
-                        cmd_errors.append( reply.lstrip(b'echo:Unknown command:').split(b'"',2)[1] )
-                        logger.debug(f"{cmd_errors[-1] = }")
-                    else:
-                        ack_pile.append( (None, ('echo', reply)), '3' )
-                elif reply.startswith(b'//'):
-                    #add_to_ack( (pendulum.now(), (reply.decode().rstrip('\n'), 'misc_status')) )
+                case Position(text=text):
+                    redraw.mark(machine_pos, partial(machine_pos.set_text, text))
+                case Temperature():
+                    show_temperatures(event)
+                case UnknownCommand(command=command):
+                    cmd_errors.append(command)
+                    logger.debug(f"{cmd_errors[-1] = }")
+                case Echo() | Busy():
+                    ack_pile.append( (None, ('echo', reply)), '3' )
+                case Comment():
                     ack_pile.append( (None, ('misc_status', reply)), '4' )
-                else:
+                case Resend(N=n):
+                    skip_acks += 1
+                    if LINES is None:
+                        logger.error(f"machine requested a resend but lines are not numbered (see --checksum): {reply}")
+                    else:
+                        try:
+                            for line in LINES.resend(n):
+                                s.write(line)
+                        except KeyError as e:
+                            logger.error(f"{e} ; the print is likely compromised")
+                    ack_pile.append( (None, ('error', reply)), '6' )
+                case _:
                     # TODO works with Marlin 2.1.x, not 1.x, other firmwres untested (put in config?)
                     if reply == b'pages_ready':
                         MACHINE_READY = True
                         logger.info("machine ready")
-                        messages.contents = [ (urwid.Text(('',b'Machine ready :-)')), ('pack',None)), *messages.contents ]
+                        message(b'Machine ready :-)')
                     elif reply == b'start':
-                        machine_status.set_text((b'status_OK',machine_status.get_text()[0]))
+                        set_status('status_OK')
 
                     ack_pile.append( (None, ('status_msg', reply)), '5' )
 
-            except GotTempReport:
-                #messages.set_text(reply.decode().rstrip('\n'))
-                temps = reply.split(b' ')[1:]
-                for t in range(len(temps)//3):
-                    try:
-                        label, temp = temps[2*t].split(b':')
-                        target = float(temps[2*t+1].lstrip(b'/'))
-                        pwr = int(temps[2*len(temps)//3+t].split(b':')[1])
-                        #messages.set_text(f"{label}: {temp}/{target}°C @{pwr}")
-                        tbars[label][0].set_completion(pwr)
-                        tbars[label][1].set_completion(target)
-                        tbars[label][2].set_completion(float(temp))
-                    except (ValueError, IndexError) as e:
-                        logger.info(f"{e} (GJE72JDH): {bab.to_braille(reply)}")
-
             # downshift commands if required (send to printer)
             if MACHINE_READY:
                 while len(wai_pile) and not wip_pile.is_saturated:
                     pop_to_serial(s, wai_pile )
 
-                if not PRINT_PAUSED:
+                if not PRINT_PAUSED and interleaver is not None:
+                    # the files layer by layer (see interleave.py)
+                    while len(interleaver) and not wip_pile.is_saturated:
+                        pop_to_serial(s, interleaver)
+                elif not PRINT_PAUSED:
                     for gco_pile in gcode_piles.keys():
                         if EXTRA_DEBUG: logger.debug(f"flushing pile {gco_pile}")
                         while len(gcode_piles[gco_pile]) and not wip_pile.is_saturated:
                             #logger.info(f"will pop {gcode_piles[gco_pile].content[0]}")
                             pop_to_serial(s, gcode_piles[gco_pile] )
                             #logger.info(f"flushing pile {gcode_piles[gco_pile]}")
-                            #sleep(1)
-
-            try:
-                os.write( watch_pipe, b'nop\n' )
-            except TypeError:
-                pass
-            except OSError:
-                machine_status.set_text((b'status_UNK',machine_status.get_text()[0]))
-                try:
-                    if messages.contents[0] is not watch_pipe_error:
-                        messages.contents = [ watch_pipe_error, *messages.contents ]
-                except KeyError:
-                    messages.contents = [ watch_pipe_error, *messages.contents ]
-                finally:
-                    serial_comm_still_ok(b'OSError\n')
+                await s.drain()
 
     except serial.serialutil.SerialException:
-        machine_status.set_text(('status_ERR',machine_status.get_text()[0]))
-        messages.contents = [ (urwid.Text(('error',b'connection to machine was lost')), ('pack',None)), *messages.contents ]
+        set_status('status_ERR')
+        message(b'connection to machine was lost', 'error')
 
-def serial_comm_still_ok(data):
-    global cmd_pile, all_wai
-    # NOTE we could do something with 'wait' and 'echo:busy: processing'...
+def show_temperatures(report):
+    """ updates the bars of the heaters of a temperature report (marlin_replies.Temperature) """
+    for label, (temp, target) in report.heaters.items():
+        if label in tbars and target is not None:
+            redraw.mark(('temperature', label), partial(set_temperature, label, report.powers.get(label, 0), target, temp))
+
+def cancel_gcode(name):
+    """ stops sending G-Code file `name` (or number, from 1) """
     try:
-        data = [ d for d in data.rstrip(b'\n').split(b'\n') if d != b'nop' ]
-    except Exception as e:
-        raise Exception( e, data)
-    if len(data):
-        for d in data:
-            if d == 'OSError':
-                try:            os.close( watch_pipe )
-                except OSError: pass
-                finally:
-                    messages.contents = [ (urwid.Text(('error','watch_pipe was lost ; display refresh issues ahead')), ('pack',None)), *messages.contents ]
-                    return False
-            else:
-                messages.contents = [ (urwid.Text(('',f'watch_pipe: {data.decode()}')), ('pack',None)), *messages.contents ]
-    else:
-        # this must be forced / redefined, because the internal widgets change and we're not recycling widgets (TODO: FIX!)
-        all_wai = urwid.Columns([wai_pile.widget, *[gcode_piles[filename].widget for filename in gcode_piles.keys()]])
-        i = 0
-        while True:
-            try:
-                cmd_pile.contents = [ (w,('pack',None)) for w in [ ack_pile.widget, wip_pile.widget, all_wai, editmap ]]
-                break
-            except IndexError as e:
-                # deque index out of range
-                logger.warning(f"{e} (id:EH47SAJ3)")
-                break
-            except RuntimeError as e:
-                if i == 10:
-                    logger.info(f"{e} (message repeated 10 times) (id:KCD4JD72G)")
-                else:
-                    logger.debug(f"{e} (id:KCD4JD72F)")
-                    i = 0
-                i += 1
-                sleep(.1)
+        if interleaver is not None:
+            name = interleaver.cancel(name).name
+        else:
+            name = next( n for i, n in enumerate(gcode_piles, 1) if name in (n, str(i)) )
+            gcode_piles[name].content.clear()
+            gcode_piles[name].dirty()
+    except (KeyError, StopIteration):
+        message(f"no such G-Code file: `{name}`", 'error')
+        return
+    result.warning(f"; {name} was cancelled")
+    message(f"{name} cancelled")
 
-        return True
+def set_temperature(label, pwr, target, temp):
+    tbars[label][0].set_completion(pwr)
+    tbars[label][1].set_completion(target)
+    tbars[label][2].set_completion(temp)
 
 
 """This is ACK pile', 'all instructions here have been processed"""
 # add_to_ack
 commands_ack = [
-    ((pendulum.now(), (b'greeter', " Welcome to G-Code Wizard! ")),),
-    ((pendulum.now(), b"You may cast your spells now."), (pendulum.now(), b'pooof!')),
+    (None, ('greeter', " Welcome to G-Code Wizard! ")),
+    ((monotonic_ns(), b"You may cast your spells now."), ('ack_msg', b'pooof!')),
     #('G28', 'ok'),
     #('G0 Z300', 'ok',),
 ]
@@ -577,17 +725,6 @@ class UserInput(urwid.Padding):
         #if key == 'enter':
         #    raise Exception(f"{key = }, {size = }")
 
-        def widget_to_append( text ):
-            #raise Exception('widget_to_append', text)
-            return urwid.Columns([
-                    (6, urwid.Text(text[0])),
-                    urwid.Text(text[1]),
-                ])
-
-        def append_to_pile( widget ):
-            #raise Exception(widget)
-            info_dic.contents.append( (widget,('pack', None)) )
-
         #if key.startswith('ctrl'):
         #    edit.edit_text = key
         # TODO also match on partial strings if there is no ambiguity or obvious precedence
@@ -615,6 +752,13 @@ class UserInput(urwid.Padding):
                     edit.set_caption('>>> ')
             case 'ctrl p':
                 PRINT_PAUSED = not PRINT_PAUSED
+            # scroll back through the ACK pile (older entries are read back from disk)
+            case 'page up':
+                ack_pile.scroll(-DISP_ACK_LEN)
+                return
+            case 'page down':
+                ack_pile.scroll(DISP_ACK_LEN)
+                return
                 
 
         if key == 'enter' and edit.edit_text != '':
@@ -627,8 +771,18 @@ class UserInput(urwid.Padding):
                         # integer index of a previously typed command ; require confirmation with another 'enter'
                         return
                     except ValueError:
-                        # normal command or comment
-                        wai_pile.append(bytes(edit.edit_text,'utf-8'), 0)
+                        if edit.edit_text.startswith('@'):
+                            # a macro: its commands go on top of the WAIT pile, in order
+                            try:
+                                macro, cmds = macros.expand(edit.edit_text)
+                            except MacroError as e:
+                                message(str(e), 'error')
+                                return
+                            for cmd in reversed(cmds):
+                                wai_pile.append(cmd.rstrip(b'\n'), 0)
+                        else:
+                            # normal command or comment
+                            wai_pile.append(bytes(edit.edit_text,'utf-8'), 0)
                         edit.edit_text = ''
                         info_dic.contents = []
                 case 'search':
@@ -649,13 +803,26 @@ class UserInput(urwid.Padding):
                         case 'force':
                             wip_pile.append(b'NOP')
                             logger.debug("appended 'NOP' to wip_pile")  # TODO this is not the correct way to do it!
+                        case 'buffsize':
+                            wip_pile.window.cap = None
+                            message(f"in-flight window: {wip_pile.window}")
+                        case text if text.startswith('buffsize '):
+                            try:
+                                wip_pile.window.cap = int(text[9:]) or None
+                                message(f"in-flight window: {wip_pile.window}")
+                            except ValueError:
+                                message(f"uh? `{text}`", 'error')
                         case 'debug':
+                            logger.debug(wip_pile.window)
                             logger.debug(ack_pile)
                             logger.debug(wip_pile)
                             logger.debug(wai_pile)
+                            logger.debug(redraw)
                         case 'quit':
                             logger.info("quit on user request")
                             raise SystemExit
+                        case text if text.startswith('cancel '):
+                            cancel_gcode(text[7:].strip())
                         case _:
                             messages.contents = [ (urwid.Text(('error',f"uh? `{edit.edit_text}`")), ('pack',None)), *messages.contents ]
                     edit.edit_text = ''
@@ -669,20 +836,18 @@ class UserInput(urwid.Padding):
                         except KeyError:
                             info_dic.contents = []
                 case 'search':
-                    info_dic.contents = []
-                    #subcommands = []
-                    for command in valid_commands:
-                        search_and_highlight( (edit.edit_text+key).split(' '), f"{command}\t{valid_commands[command]}", widget_to_append, append_to_pile )
-                        #if (cmd := search_and_highlight( edit.edit_text.split(' '), f"{command}\t{valid_commands[command]}", widget_to_append, append_to_pile )) 
-                        #    subcommands.append( cmd )
-                    if len(info_dic.contents) == 1:
-                        #raise Exception(info_dic.contents[0][0].contents[0][0].get_text())
-                        edit.edit_text = info_dic.contents[0][0].contents[0][0].get_text()[0]
+                    # the query is what is in the edit box once the key was handled (backspace...)
+                    super().keypress(size, key)
+                    found = command_index.search(edit.edit_text)
+                    if len(found) == 1:
+                        edit.edit_text = command_index.commands[found[0]]
                         edit.edit_pos = len(edit.edit_text)
                         EDIT_MODE = 'normal'
                         edit.set_caption('>>> ')
+                        info_dic.contents = []
                         return
-                        #return super().keypress(119, 'enter')
+                    info_dic.contents = [ (search_row(i, edit.edit_text), ('pack',None)) for i in found ]
+                    return
                 case 'command':
                     info_dic.contents = [
                         (urwid.Text('Available commands:'),('pack',None)),
@@ -694,65 +859,66 @@ class UserInput(urwid.Padding):
                         (urwid.Text('save <filename.gcode> TODO'),('pack',None)),
                         (urwid.Text("flush (abort print & clear 'wait' pile) TODO"),('pack',None)),
                         (urwid.Text("force (push one more command into WIP queue... sometimes bad reporting! TODO)"),('pack',None)),
+                        (urwid.Text('cancel <filename.gcode|number> (stop printing one file, the others go on)'),('pack',None)),
                         (urwid.Text('connect <port> TODO'),('pack',None)),
-                        (urwid.Text('buffsize <int> TODO'),('pack',None)),
+                        (urwid.Text('buffsize [<int>] (at most <int> commands in flight, none: adaptive only)'),('pack',None)),
                         (urwid.Text('debug'),('pack',None)),
                         (urwid.Text('quit'),('pack',None)),
+                        *[ (urwid.Text(f"{macro} (in normal mode)"),('pack',None)) for macro in macros ],
                     ]
             return super().keypress(size, key)
 
-try:
-    from hello_world import dummy_compiler
-except ImportError:
-    def dummy_compiler( data, ttable = None, oddLine = True ):
-        return [data], [None for _ in range(len(data))]
-
-def search_and_highlight( needle, stack, widget = tuple, target = print ):
-    #stack = [s[::-1] for s in stack[::-1].split('\t',1)[::-1]]
-    cmd, desc = stack.split('\t',1)
-    if all(n in desc for n in needle):
-        out, flags = dummy_compiler( desc, needle )
-        desc = []
-        j = 0
-        for i in range(len(out)):
-            if flags[i]:
-                #desc += fore_text(out[i],color)
-                desc.append( ('', out[i] ) )
-            else:
-                if j%2:
-                    #desc += fore_text(out[i],HL0)
-                    desc.append( ('HL0', out[i] ) )
-                else:
-                    #desc += fore_text(out[i],HL1)
-                    desc.append( ('HL1', out[i] ) )
-                j += 1
-        #raise Exception(widget, cmd, desc)
-        target( widget( (cmd, desc) ) )
+# one row per command, created when it is first found and reused afterwards
+search_rows = {}
+
+def search_row( i, text ):
+    """ the info row of command `i` with the search terms (`text`) highlighted """
+    try:
+        row = search_rows[i]
+    except KeyError:
+        row = search_rows[i] = urwid.Columns([
+                (6, urwid.Text(command_index.commands[i])),
+                urwid.Text(''),
+            ])
+    row.contents[1][0].set_text( command_index.highlight(i, text) )
+    return row
 
 
-def main(SER, machine_name, serial_port, maxtemp, gcodes):
-    global loop, edit, ack_pile, wip_pile, wai_pile, machine_pos, messages, tbars, info_dic, watch_pipe, machine_status, gcode_piles, div, cmd_pile, all_wai, editmap
+def main(SER, machine_name, serial_port, maxtemp, gcodes, compiled = False, checksum = False, fps = MAX_FPS, ack_history = None, interleave = False):
+    global LINES, redraw, loop, edit, ack_pile, wip_pile, wai_pile, machine_pos, messages, tbars, info_dic, event_loop, machine_status, gcode_piles, div, cmd_pile, all_wai, editmap, interleaver
 
-    from threading import Thread
-    t = Thread(target=read_from_serial, args=(SER,), daemon = True )
+    # serial I/O and the interface share this loop, nothing else touches the piles
+    event_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(event_loop)
     edit = urwid.Edit(('prompt',">>> "))
 
     div = urwid.Divider('-')
     #from time import sleep
     #sleep(2)
 
-    ack_pile = ACKPile( 'ACK Pile', commands_ack, display_size=DISP_ACK_LEN, color='acked' )
-    wip_pile = WIPPile( 'Processing...', max_content_len=MAX_COMMANDS_IN_WIP, display_size=MAX_COMMANDS_IN_WIP, color='wip' )   # this is WIP pile, instructions have been sent to the machine but not acked yet
+    ack_pile = ACKPile( 'ACK Pile', commands_ack, spill=ack_history, display_size=DISP_ACK_LEN, color='acked' )
+    wip_pile = WIPPile( 'Processing...', display_size=MAX_COMMANDS_IN_WIP, color='wip' )   # this is WIP pile, instructions have been sent to the machine but not acked yet
     wai_pile = WQueue( 'User input pile', commands_wai, display_size=DISP_WAI_LEN, viewport_start=0 )
+    if checksum:
+        LINES = ResendWindow()
+        # start numbering lines from here
+        wai_pile.append(b'M110 N0', 0)
 
     gcode_piles = {}
     if gcodes:
         for gcode in gcodes:
             logger.info(f"Loading file: {gcode}")
-            with open(gcode,'rb') as g:
-                gcode_piles[gcode] = WQueue( gcode, [line.rstrip(b'\n').replace(b'\t', b' ') for line in g.readlines() if line != b'\n'], display_size=DISP_WAI_LEN, viewport_start=0 )
+            if compiled or gcode.endswith(SUFFIX):
+                # comments are gone, commands are ready to be sent (see gcode_compile.py)
+                gcode_piles[gcode] = FilePile( gcode, CompiledLines(load_or_compile(gcode)), display_size=DISP_WAI_LEN, viewport_start=0 )
+                continue
+            # indexed in the background, the pile fills up as it goes
+            gcode_piles[gcode] = FilePile( gcode, MappedLines(gcode), display_size=DISP_WAI_LEN, viewport_start=0 )
         #logger.info(gcode_piles[gcode])
         #logger.info(gcode_piles[gcode].widget.contents)
+        if interleave and len(gcode_piles) > 1:
+            # the layers of each file are scanned in the background
+            interleaver = ZInterleaver(gcode_piles)
 
     #logger.info('>>>', wai_pile.widget)
     #logger.info('>>>', [gcode_piles[filename].widget for filename in gcode_piles.keys()])
@@ -812,10 +978,20 @@ def main(SER, machine_name, serial_port, maxtemp, gcodes):
 
     filler = urwid.Filler(cols, "top")
     frame  = urwid.Frame(filler, header=titlemap)
-    loop   = urwid.MainLoop(frame, palette)
-    watch_pipe = loop.watch_pipe(serial_comm_still_ok)
-
-    t.start()
+    loop   = urwid.MainLoop(frame, palette, event_loop=urwid.AsyncioEventLoop(loop=event_loop))
+    redraw = RedrawScheduler(fps)
+    # whatever was loaded before the scheduler existed
+    for pile in gcode_piles.values():
+        pile.dirty()
+
+    def serial_done(task):
+        if not task.cancelled() and (e := task.exception()) is not None:
+            logger.critical(f"serial I/O failed: {e!r}")
+            set_status('status_ERR')
+            message(f"serial I/O failed: {e}", 'error')
+
+    serial_task = event_loop.create_task(read_from_serial(SER))
+    serial_task.add_done_callback(serial_done)
     loop.run()
 
 
@@ -828,8 +1004,13 @@ if __name__ == '__main__':
     )
     parser.add_argument("-c", "--config", help="machine configuration", default = None, metavar="file")
     parser.add_argument("-g", "--gcode", help="gcode to preload", default = None, metavar="file", nargs='*')
+    parser.add_argument("--compile", action='store_true', help="load gcode files from their compiled form (<file>.gwc, reused if up to date, see gcode_compile.py)")
+    parser.add_argument("-z", "--interleave", action='store_true', help="print the gcode files layer by layer instead of one after the other (see interleave.py)")
     parser.add_argument("-p", "--port", default = None, help="serial port override", metavar="device")
     parser.add_argument("-b", "--baudrate", default = None, type=int, help="baud rate override", metavar="int")
+    parser.add_argument("--checksum", action='store_true', help="send line numbers and checksums, resend lines on request")
+    parser.add_argument("--fps", default = MAX_FPS, type=float, help="maximum screen refresh rate", metavar="float")
+    parser.add_argument("--ack-history", default = None, help="keep the ACK pile history in this file (a temporary file by default)", metavar="file")
 
     parser.add_argument("--log-level", default = None, help="log level", metavar="str")
     # TODO doesn't seem to work with config file
@@ -868,6 +1049,11 @@ if __name__ == '__main__':
                     baudrate = int(line[1].rstrip('\n')) if args.baudrate is None else args.baudrate
                 case 'maxtemp':
                     maxtemp = [int(i) for i in line[1].rstrip('\n').split(',')]
+                case 'macro':
+                    try:
+                        macros.define('='.join(line[1:]).rstrip('\n'))
+                    except MacroError as e:
+                        logger.error(f"{args.config}: {e}")
                 case '# G-Code starts here\n':
                     break
                 case other:
@@ -879,6 +1065,7 @@ if __name__ == '__main__':
                 command, desc = line.rstrip('\n').split('=')
                 valid_commands[command] = desc
                 #logger.info("GOT COMMAND:",command,desc)
+    command_index = CommandIndex(valid_commands)
 
     result = logging.getLogger(machine_name)    # TODO looks like this inherits from root logger because it seems to use handler_streamHandler that prints CRITICAL messages on stderr and always
     f_handler = logging.FileHandler( machine_name+'.out' if args.out is None else args.out )
@@ -893,10 +1080,10 @@ if __name__ == '__main__':
         for gcode in args.gcode:
             if gcode is not None and os.path.exists(gcode):
                 if os.path.isfile(gcode):
-                    if gcode.strip().lower().endswith(".gcode"):
+                    if gcode.strip().lower().endswith( (".gcode", SUFFIX) ):
                         continue
                     else:
-                        logger.critical(f"{gcode} does not have .gcode extension.")
+                        logger.critical(f"{gcode} does not have .gcode or {SUFFIX} extension.")
                         sys.exit()
                 else:
                     logger.critical(f"{gcode} is not a file.")
@@ -926,4 +1113,9 @@ if __name__ == '__main__':
         machine_name, serial_port,
         maxtemp,
         args.gcode,
+        args.compile,
+        args.checksum,
+        args.fps,
+        args.ack_history,
+        args.interleave,
     )
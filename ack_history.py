@@ -0,0 +1,143 @@
+"""
+	bounded history of what the machine acknowledged (the ACK pile in GWiz)
+
+	recent entries are kept in memory as compact records (monotonic timestamps
+	in ns, interned status, the command and reply bytes) in a ring of `ring`
+	records ; older ones are spilled to an append-only file and read back only
+	when scrolling through them. Timestamps are formatted when displayed.
+
+	spill file: RECORD followed by the command and the reply, for every record ;
+	the offset of one record in SPILL_INDEX_EVERY is kept in memory.
+"""
+import os
+import struct
+import logging
+import tempfile
+from array import array
+from collections import deque
+from functools import lru_cache
+from time import localtime, monotonic_ns, strftime, time_ns
+
+logger = logging.getLogger('stderrLogger')
+
+# sent, acked [ns], status, command length (0xffff: no command), reply length
+RECORD = struct.Struct('<qqBHH')
+NO_COMMAND = 0xffff
+SPILL_INDEX_EVERY = 256
+# monotonic_ns() + EPOCH_NS = wall clock
+EPOCH_NS = time_ns()-monotonic_ns()
+
+# interned statuses (urwid palette entries, ie. 'ack_msg', 'error', 'echo', ...)
+STATUSES = [None]
+_STATUS_CODES = {None: 0}
+
+def status_code(status):
+	if (code := _STATUS_CODES.get(status)) is None:
+		code = _STATUS_CODES[status] = len(STATUSES)
+		STATUSES.append(status)
+	return code
+
+@lru_cache(maxsize=64)
+def _format_second(second, fmt):
+	return strftime(fmt, localtime(second))
+
+def format_ns(ns, fmt = "%Y-%m-%d %H:%M:%S"):
+	""" wall-clock time of a monotonic_ns() timestamp """
+	return _format_second((ns+EPOCH_NS)//1_000_000_000, fmt)
+
+
+class AckRecord:
+	""" a command and the machine's reply ; either may be None """
+	__slots__ = ('sent', 'acked', 'status', 'command', 'reply')
+
+	def __init__(self, sent, acked, status, command, reply):
+		self.sent = sent
+		self.acked = acked
+		self.status = status
+		self.command = command
+		self.reply = reply
+
+	def __repr__(self):
+		return f"<AckRecord: {self.command} -> {STATUSES[self.status]}:{self.reply}>"
+
+	def markup(self):
+		""" the reply as urwid text markup """
+		if self.reply is None:
+			return ''
+		return self.reply if self.status == 0 else (STATUSES[self.status], self.reply)
+
+	def pack(self):
+		command = b'' if self.command is None else self.command
+		reply = b'' if self.reply is None else self.reply if isinstance(self.reply, bytes) else self.reply.encode()
+		return RECORD.pack(-1 if self.sent is None else self.sent, self.acked, self.status,
+			NO_COMMAND if self.command is None else len(command), len(reply)) + command + reply
+
+
+class AckHistory:
+	"""
+		sequence of AckRecord: the last `ring` in memory, the others in `path`
+		(an anonymous temporary file by default)
+	"""
+	def __init__(self, ring = 4096, path = None):
+		self.ring = deque()
+		self.ring_size = ring
+		self.spilled = 0
+		self.spill = tempfile.TemporaryFile() if path is None else open(path, 'ab+')
+		self.spill_size = self.spill.seek(0, os.SEEK_END)
+		self.spill_index = array('Q')
+
+	def __str__(self):
+		return f"<AckHistory: {len(self.ring)} records in memory, {self.spilled} spilled ({self.spill_size} bytes)>"
+
+	def __len__(self):
+		return self.spilled+len(self.ring)
+
+	def append(self, record):
+		self.ring.append(record)
+		if len(self.ring) > self.ring_size:
+			self._spill(self.ring.popleft())
+
+	def _spill(self, record):
+		if not self.spilled % SPILL_INDEX_EVERY:
+			self.spill_index.append(self.spill_size)
+		data = record.pack()
+		self.spill.write(data)
+		self.spill_size += len(data)
+		self.spilled += 1
+
+	def _read_spilled(self, start, stop):
+		""" records `start` to `stop` from the spill file """
+		self.spill.flush()
+		fd = self.spill.fileno()
+		offset = self.spill_index[start//SPILL_INDEX_EVERY]
+		records = []
+		for i in range(start - start % SPILL_INDEX_EVERY, stop):
+			sent, acked, status, command_len, reply_len = RECORD.unpack(os.pread(fd, RECORD.size, offset))
+			offset += RECORD.size
+			length = (0 if command_len == NO_COMMAND else command_len)+reply_len
+			if i >= start:
+				data = os.pread(fd, length, offset)
+				command = None if command_len == NO_COMMAND else data[:command_len]
+				records.append(AckRecord(None if sent == -1 else sent, acked, status, command, data[len(data)-reply_len:] if reply_len else None))
+			offset += length
+		return records
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			start, stop, step = i.indices(len(self))
+			if step != 1:
+				return [self[j] for j in range(start, stop, step)]
+			records = self._read_spilled(start, min(stop, self.spilled)) if start < self.spilled else []
+			ring = self.ring
+			return records + [ring[j-self.spilled] for j in range(max(start, self.spilled), stop)]
+		n = len(self)
+		if i < 0:
+			i += n
+		if not 0 <= i < n:
+			raise IndexError("AckHistory index out of range")
+		if i >= self.spilled:
+			return self.ring[i-self.spilled]
+		return self._read_spilled(i, i+1)[0]
+
+	def close(self):
+		self.spill.close()
@@ -2,9 +2,12 @@ import asyncio
 from collections import deque
 
 class AsyncDeque(deque):
-	def __init__(self, *args, **kwargs):
+	def __init__(self, *args, wakeup = None, **kwargs):
 		super().__init__(*args, **kwargs)
 		self._not_empty = asyncio.Condition()  # For signaling when items are added
+		self._not_full = asyncio.Event()  # For signaling when room is made in a bounded deque
+		self._not_full.set()
+		self._wakeup = wakeup  # Optional event shared with a consumer that watches several deques
 		self._stopped = False  # To indicate when the deque is stopped
 
 	def __aiter__(self):
@@ -18,11 +21,38 @@ class AsyncDeque(deque):
 				raise StopAsyncIteration
 			return self.popleft()
 
+	def popleft(self):
+		item = super().popleft()
+		self._not_full.set()
+		return item
+
 	async def put(self, item):
-		"""Add an item to the deque and notify waiting consumers."""
+		"""Add an item to the deque and notify waiting consumers.
+
+		A bounded deque would silently drop its oldest item, so wait for room instead."""
+		while self.maxlen is not None and len(self) >= self.maxlen:
+			self._not_full.clear()
+			await self._not_full.wait()
 		async with self._not_empty:
 			self.append(item)
 			self._not_empty.notify()
+		if self._wakeup is not None:
+			self._wakeup.set()
+
+	async def put_all(self, items):
+		"""Add several items at once, nothing else gets between them.
+
+		Waits until there is room for all of them."""
+		if self.maxlen is not None and len(items) > self.maxlen:
+			raise ValueError(f"{len(items)} items can't fit in {self.maxlen}")
+		while self.maxlen is not None and len(self)+len(items) > self.maxlen:
+			self._not_full.clear()
+			await self._not_full.wait()
+		async with self._not_empty:
+			self.extend(items)
+			self._not_empty.notify(len(items))
+		if self._wakeup is not None:
+			self._wakeup.set()
 
 	async def stop(self):
 		"""Stop all waiting consumers by notifying them."""
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+	throughput benchmarks of gp and GWiz against the simulated firmware (marlin_sim.py)
+
+	every host is run on every G-Code file (synthetic reference files unless
+	files are given) with a fresh simulated machine, and timed from the first
+	move to the last command:
+
+	- commands/s
+	- starvation ratio: share of that time the planner was empty (the host
+	  didn't keep up)
+	- host turnaround: time between an `ok` sent while the machine was moving
+	  with an empty command buffer and the next line received (median and 95th
+	  percentile), ie. the end-to-end latency added by the host
+
+	gp is started with `go` over TCP, GWiz with ctrl+p in a pseudo-terminal.
+"""
+import asyncio
+import os
+import sys
+import json
+import fcntl
+import struct
+import termios
+import tempfile
+import logging
+import random
+from contextlib import suppress
+
+from marlin_sim import MarlinSim, MOVES
+from gcode_compile import compile_line
+
+logger = logging.getLogger('stderrLogger')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GP_TCP_PORT = 7000
+GWIZ_CONFIG = os.path.join(HERE, 'configs', 'lulzbot-mini.conf')
+# the run is over when nothing was executed for this long
+IDLE_TIMEOUT = 5
+
+def reference_files(directory, lines = 5000, seed = 0):
+	""" writes the synthetic reference files, returns their paths """
+	rnd = random.Random(seed)
+	paths = []
+
+	# tiny segments (curves sliced at high resolution): the host has to keep up
+	path = os.path.join(directory, 'segments.gcode')
+	with open(path, 'w') as f:
+		f.write("G90\nM83\nG28\n")
+		x, y = 100., 100.
+		for i in range(lines):
+			x += rnd.uniform(-.2, .2)
+			y += rnd.uniform(-.2, .2)
+			f.write(f"G1 X{x:.3f} Y{y:.3f} E{rnd.uniform(0, .01):.5f}\n")
+	paths.append(path)
+
+	# what slicers output: heating, comments, travels, retracts, fan, long lines
+	path = os.path.join(directory, 'mixed.gcode')
+	with open(path, 'w') as f:
+		f.write("; generated by benchmark.py\nM140 S60\nM104 S200\nM190 S60\nM109 S200\nG28\nG90\nM82\nG92 E0\n")
+		e = 0.
+		for i in range(lines):
+			if not i % 200:
+				f.write(f";LAYER:{i//200}\nG1 Z{.2+i//200*.2:.2f} F600\nM106 S{rnd.randrange(256)}\n")
+			if not i % 25:
+				f.write(f"G1 E{e-.8:.5f} F2400 ; retract\nG0 X{rnd.uniform(0, 200):.3f} Y{rnd.uniform(0, 200):.3f} F9000\nG1 E{e:.5f} F2400\n")
+			e += rnd.uniform(0, .05)
+			f.write(f"G1 X{rnd.uniform(0, 200):.3f} Y{rnd.uniform(0, 200):.3f} E{e:.5f} F1800 ; perimeter\n")
+		f.write("M104 S0\nM140 S0\nM107\n")
+	paths.append(path)
+	return paths
+
+def count_moves(path):
+	moves = 0
+	with open(path, 'rb') as f:
+		for line in f:
+			if (compiled := compile_line(line)) is not None and compiled[0].split(None, 1)[0].upper() in MOVES:
+				moves += 1
+	return moves
+
+async def wait_done(sim, moves, timeout):
+	""" until all moves were executed, nothing happened for IDLE_TIMEOUT or `timeout` expired """
+	loop = asyncio.get_running_loop()
+	start = loop.time()
+	last_count, last_change = -1, start
+	while loop.time()-start < timeout:
+		await asyncio.sleep(.1)
+		if sim.stats['moves'] >= moves and not sim.planner:
+			return True
+		if sim.stats['commands'] != last_count:
+			last_count, last_change = sim.stats['commands'], loop.time()
+		elif sim.stats['first'] is not None and loop.time()-last_change > IDLE_TIMEOUT:
+			break
+	logger.warning(f"benchmark stopped with {sim.stats['moves']}/{moves} moves executed")
+	return False
+
+async def run_gp(sim, path, args):
+	cmd = [sys.executable, 'gp', '-p', sim.port, '-b', '115200', '-g', path, '--telemetry', '', '-o', os.devnull]
+	if args.checksum:
+		cmd.append('--checksum')
+	proc = await asyncio.create_subprocess_exec(*cmd, cwd=HERE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+	try:
+		# gp sends G4 once the machine is ready
+		while not sim.stats['commands']:
+			if proc.returncode is not None:
+				logger.error(f"gp exited ({proc.returncode}) before sending anything")
+				return False
+			await asyncio.sleep(.1)
+		_, writer = await asyncio.open_connection('localhost', GP_TCP_PORT)
+		writer.write(b'go\n')
+		await writer.drain()
+		writer.close()
+		return await wait_done(sim, count_moves(path), args.timeout)
+	finally:
+		if proc.returncode is None:
+			proc.terminate()
+		await proc.wait()
+
+async def run_gwiz(sim, path, args):
+	cmd = [sys.executable, 'GWiz.py', '-c', GWIZ_CONFIG, '-p', sim.port, '-b', '115200', '-g', path, '-o', os.devnull]
+	if args.checksum:
+		cmd.append('--checksum')
+	master, slave = os.openpty()
+	fcntl.ioctl(slave, termios.TIOCSWINSZ, struct.pack('HHHH', 50, 160, 0, 0))
+	proc = await asyncio.create_subprocess_exec(*cmd, cwd=HERE, stdin=slave, stdout=slave, stderr=slave,
+		start_new_session=True, env={**os.environ, 'TERM': 'xterm'})
+	os.close(slave)
+	loop = asyncio.get_running_loop()
+	def discard():
+		try:
+			os.read(master, 65536)
+		except OSError:
+			loop.remove_reader(master)
+	# the screen updates must be read or GWiz blocks
+	loop.add_reader(master, discard)
+	try:
+		# let urwid start, then unpause (ctrl+p)
+		await asyncio.sleep(3)
+		os.write(master, b'\x10')
+		return await wait_done(sim, count_moves(path), args.timeout)
+	finally:
+		loop.remove_reader(master)
+		if proc.returncode is None:
+			proc.terminate()
+		await proc.wait()
+		os.close(master)
+
+HOSTS = {'gp': run_gp, 'GWiz': run_gwiz}
+
+async def benchmark(args):
+	results = []
+	with tempfile.TemporaryDirectory() as directory:
+		files = args.gcode or reference_files(directory, args.lines)
+		for path in files:
+			for host in args.hosts:
+				sim = MarlinSim(args.planner, args.buffer, args.move_time, corrupt=args.corrupt, seed=0)
+				task = asyncio.create_task(sim.run())
+				try:
+					complete = await HOSTS[host](sim, path, args)
+				finally:
+					task.cancel()
+					with suppress(asyncio.CancelledError):
+						await task
+					sim.close()
+				results.append({'host': host, 'file': os.path.basename(path), 'complete': complete, **sim.summary()})
+				if not args.json:
+					print_result(results[-1])
+	return results
+
+def print_result(r):
+	ms = lambda t: '-' if t is None else f"{t*1000:.2f}"
+	line = (f"{r['host']:6} {r['file']:20} {r['commands']:7} cmds {r['seconds']:7.2f} s {r['commands_per_second']:8.1f} cmd/s "
+		f"starvation {r['starvation_ratio']*100:5.1f}% turnaround p50 {ms(r['turnaround_p50'])} ms p95 {ms(r['turnaround_p95'])} ms")
+	if r['resends']:
+		line += f" ({r['corrupted']} corrupted, {r['resends']} resends)"
+	if not r['complete']:
+		line += " INCOMPLETE"
+	print(line, flush=True)
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog="benchmark",
+		description="throughput benchmarks of gp and GWiz against a simulated Marlin (marlin_sim.py)",
+	)
+	parser.add_argument("gcode", help="G-Code files (synthetic reference files by default)", metavar="file", nargs='*')
+	parser.add_argument("--hosts", default = list(HOSTS), nargs='+', choices=HOSTS, help="hosts to benchmark")
+	parser.add_argument("--lines", default = 5000, type=int, help="size of the reference files", metavar="int")
+	parser.add_argument("--planner", default = 16, type=int, help="planner size (BLOCK_BUFFER_SIZE)", metavar="int")
+	parser.add_argument("--buffer", default = 4, type=int, help="command buffer size (BUFSIZE)", metavar="int")
+	parser.add_argument("--move-time", default = .001, type=float, help="time to execute one move [s]", metavar="float")
+	parser.add_argument("--corrupt", default = 0., type=float, help="probability that a line gets corrupted", metavar="float")
+	parser.add_argument("--checksum", action='store_true', help="run the hosts with --checksum")
+	parser.add_argument("--timeout", default = 300, type=int, help="maximum duration of a single run [s]", metavar="int")
+	parser.add_argument("--json", action='store_true', help="print the results as JSON")
+	args = parser.parse_args()
+
+	results = asyncio.run(benchmark(args))
+	if args.json:
+		print(json.dumps(results, indent=1))
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+	list-like sequence with O(log n) positional access, insert and delete
+
+	the items are kept in chunks of CHUNK_SIZE items and a Fenwick tree over the
+	chunk lengths finds the chunk holding a given position. Popping from the
+	head (what happens to a pile being printed) is a pop in the first chunk. A
+	chunk that grows to twice CHUNK_SIZE is split and empty chunks are dropped
+	once they are half of them ; both rebuild the tree, which costs
+	O(n/CHUNK_SIZE) once every few hundred operations.
+
+	run it to compare it with collections.deque on a G-Code sized pile.
+"""
+from itertools import accumulate
+
+CHUNK_SIZE = 512
+
+class ChunkedSequence:
+	def __init__(self, items = ()):
+		items = list(items)
+		self.chunks = [items[i:i+CHUNK_SIZE] for i in range(0, len(items), CHUNK_SIZE)]
+		self.length = len(items)
+		self.empty = 0
+		self._rebuild()
+
+	def __repr__(self):
+		return f"<ChunkedSequence: {self.length} items in {len(self.chunks)} chunks>"
+
+	def _rebuild(self):
+		""" the Fenwick tree of the chunk lengths (1-based) """
+		prefix = [0, *accumulate(map(len, self.chunks))]
+		self.tree = [prefix[i]-prefix[i-(i & -i)] for i in range(len(prefix))]
+		# the highest power of two <= number of chunks, where the search starts
+		self._top = 1 << (len(self.chunks).bit_length()-1) if self.chunks else 0
+
+	def _add(self, c, delta):
+		""" chunk `c` grew by `delta` items """
+		c += 1
+		while c < len(self.tree):
+			self.tree[c] += delta
+			c += c & -c
+
+	def _locate(self, pos):
+		""" (chunk, index in the chunk) of item `pos`, which must be in range """
+		c, step = 0, self._top
+		while step:
+			if c+step < len(self.tree) and self.tree[c+step] <= pos:
+				c += step
+				pos -= self.tree[c]
+			step >>= 1
+		return c, pos
+
+	def _position(self, pos):
+		if pos < 0:
+			pos += self.length
+		if not 0 <= pos < self.length:
+			raise IndexError("ChunkedSequence index out of range")
+		return pos
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, pos):
+		if isinstance(pos, slice):
+			start, stop, step = pos.indices(self.length)
+			if step != 1:
+				return [self[i] for i in range(start, stop, step)]
+			return list(self.islice(start, stop))
+		c, i = self._locate(self._position(pos))
+		return self.chunks[c][i]
+
+	def __setitem__(self, pos, item):
+		c, i = self._locate(self._position(pos))
+		self.chunks[c][i] = item
+
+	def __delitem__(self, pos):
+		self.pop(pos)
+
+	def __iter__(self):
+		for chunk in self.chunks:
+			yield from chunk
+
+	def __reversed__(self):
+		for chunk in reversed(self.chunks):
+			yield from reversed(chunk)
+
+	def islice(self, start, stop):
+		""" items `start` to `stop`, without walking through the ones before `start` """
+		start, stop = max(start, 0), min(stop, self.length)
+		if start >= stop:
+			return
+		c, i = self._locate(start)
+		left = stop-start
+		while left > 0 and c < len(self.chunks):
+			items = self.chunks[c][i:i+left]
+			yield from items
+			left -= len(items)
+			c, i = c+1, 0
+
+	def insert(self, pos, item):
+		""" inserts `item` before position `pos` (like list.insert) """
+		if pos < 0:
+			pos = max(pos+self.length, 0)
+		if pos >= self.length:
+			return self.append(item)
+		c, i = self._locate(pos)
+		chunk = self.chunks[c]
+		chunk.insert(i, item)
+		self.length += 1
+		if len(chunk) >= 2*CHUNK_SIZE:
+			self.chunks[c:c+1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+			self._rebuild()
+		else:
+			self._add(c, 1)
+
+	def append(self, item):
+		if self.chunks and len(self.chunks[-1]) < CHUNK_SIZE:
+			self.chunks[-1].append(item)
+			self._add(len(self.chunks)-1, 1)
+		else:
+			self.chunks.append([item])
+			self._rebuild()
+		self.length += 1
+
+	def appendleft(self, item):
+		self.insert(0, item)
+
+	def extend(self, items):
+		for item in items:
+			self.append(item)
+
+	def pop(self, pos = -1):
+		c, i = self._locate(self._position(pos))
+		chunk = self.chunks[c]
+		item = chunk.pop(i)
+		self.length -= 1
+		self._add(c, -1)
+		if not chunk:
+			# empty chunks are skipped by _locate, drop them once in a while
+			self.empty += 1
+			if self.empty > len(self.chunks)//2:
+				self.chunks = [chunk for chunk in self.chunks if chunk]
+				self.empty = 0
+				self._rebuild()
+		return item
+
+	def popleft(self):
+		if not self.chunks or not self.chunks[0]:
+			return self.pop(0)
+		# the head chunk is dropped (not left empty) so that this stays the fast path
+		item = self.chunks[0].pop(0)
+		self.length -= 1
+		if self.chunks[0]:
+			self._add(0, -1)
+		else:
+			del self.chunks[0]
+			self._rebuild()
+		return item
+
+	def clear(self):
+		self.chunks = []
+		self.length = self.empty = 0
+		self._rebuild()
+
+
+if __name__ == '__main__':
+	import argparse
+	import random
+	from collections import deque
+	from time import perf_counter
+
+	parser = argparse.ArgumentParser(
+		prog="chunked_seq",
+		description="compares ChunkedSequence with collections.deque (as used by the GWiz piles)",
+	)
+	parser.add_argument("-n", "--lines", default = 1_000_000, type=int, help="size of the pile", metavar="int")
+	parser.add_argument("--ops", default = 2000, type=int, help="number of operations of each kind", metavar="int")
+	args = parser.parse_args()
+
+	def rotate_pop(d, pos):
+		# what WQueue.pop did
+		d.rotate(-pos)
+		item = d.popleft()
+		d.rotate(pos)
+		return item
+
+	rnd = random.Random(0)
+	lines = [b'G1 X%d Y%d E0.01' % (i%200, i//200%200) for i in range(args.lines)]
+	positions = [rnd.randrange(args.lines//2) for _ in range(args.ops)]
+	benchmarks = {
+		'pop head':			(lambda s: s.popleft(), lambda s: s.popleft()),
+		'index middle':		(lambda s, p: s[p], lambda s, p: s[p]),
+		'insert middle':	(lambda s, p: s.insert(p, b'M400'), lambda s, p: s.insert(p, b'M400')),
+		'delete middle':	(lambda s, p: rotate_pop(s, p), lambda s, p: s.pop(p)),
+		'viewport (10)':	(lambda s, p: [s[p+i] for i in range(10)], lambda s, p: s[p:p+10]),
+	}
+	print(f"{args.lines} lines, {args.ops} operations of each kind [µs/op]")
+	print(f"{'':16}{'deque':>12}{'ChunkedSequence':>18}")
+	for name, (with_deque, with_chunks) in benchmarks.items():
+		times = []
+		for sequence, op in ((deque(lines), with_deque), (ChunkedSequence(lines), with_chunks)):
+			start = perf_counter()
+			if name == 'pop head':
+				for _ in range(args.ops):
+					op(sequence)
+			else:
+				for p in positions:
+					op(sequence, p)
+			times.append((perf_counter()-start)/args.ops*1e6)
+		print(f"{name:16}{times[0]:12.2f}{times[1]:18.2f}")
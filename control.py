@@ -0,0 +1,134 @@
+"""
+	JSON lines control protocol of gp, next to the line protocol on the same port
+
+	a line starting with `{` is a request, `id` is echoed in everything that
+	answers it:
+
+	- {"id": 1, "op": "send", "commands": ["G28", "M105"]} queues the commands
+	  in one go and answers {"id": 1, "queued": 2}. A single command is sent
+	  right away like a line of the line protocol, several are sent ahead of
+	  the file but within the machine's buffers ; then, as the machine
+	  acknowledges them, one result per command: {"id": 1, "index": 0,
+	  "command": "G28", "ok": true, "acked": true, "replies": [..., "ok P15 B3"]}
+	  (`ok` is false if the machine answered an error, `acked` is false if the
+	  command was given up by a flow control recovery)
+	- with "stream": <name> and "seq": <number of the first command>, the
+	  commands are sent like those of a file (after `go`, within the machine's
+	  buffers) and each result has its `seq` ; a client that reconnects sends
+	  again what wasn't acknowledged and what was already received is skipped
+	  ; the answer has `acked_through`, the last `seq` whose result was sent
+	  (the results sent to a connection that was lost are not sent again)
+	  (tcp_client.py --stream)
+	- {"id": 2, "op": "macro", "macro": "@heat 210"} runs a macro of the
+	  machine config (see macros.py), its commands are queued together and
+	  each gets its result like with `send`
+	- {"op": "subscribe", "topics": ["replies", "temperature", "progress"]}
+	  and {"op": "unsubscribe"} (every topic if none is given)
+	- {"op": "info"} and {"op": "metrics"} answer {"id": ..., "result": {...}}
+	- go, pause, hot, ping, buffsize, telemetry and resume_on_crash do what
+	  the line protocol does (`value` for the last three) and answer
+	  {"id": ..., "ok": true}
+
+	events are {"event": <topic>, "machine": <name>, ...}. A subscriber that
+	doesn't keep up loses events instead of holding the machine up: once
+	HIGH_WATER bytes wait to be sent to it, events are dropped and counted,
+	and it gets {"event": "dropped", "count": n} when it catches up. Results
+	are never dropped, the client that sent the commands is made to wait
+	instead.
+"""
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger('stderrLogger')
+
+TOPICS = ('replies', 'temperature', 'progress')
+# bytes waiting to be sent to a client before its events are dropped
+HIGH_WATER = 256*1024
+# progress events are sent this often [s]
+PROGRESS_INTERVAL = 1
+# what the machine replied between two `ok`, kept for the results
+REPLIES_KEPT = 32
+
+def encode(obj):
+	return json.dumps(obj, separators=(',', ':')).encode()+b'\n'
+
+class Client:
+	""" a TCP client that talks JSON """
+	def __init__(self, writer):
+		self.writer = writer
+		self.dropped = 0
+
+	def __str__(self):
+		peer = self.writer.get_extra_info("peername")
+		return f"<Client: {peer}, {self.dropped} events dropped>"
+
+	@property
+	def congested(self):
+		return self.writer.transport.get_write_buffer_size() >= HIGH_WATER
+
+	def send(self, obj):
+		""" answers, never dropped (unless the client is gone) """
+		if not self.writer.is_closing():
+			self.writer.write(encode(obj))
+
+	def publish(self, line):
+		""" an encoded event, dropped if the client doesn't keep up """
+		if self.congested:
+			self.dropped += 1
+			return
+		if self.dropped:
+			self.writer.write(encode({'event': 'dropped', 'count': self.dropped}))
+			self.dropped = 0
+		self.writer.write(line)
+
+class Stream:
+	""" a remote file (tcp_client.py --stream), outlives the connections of its client """
+	def __init__(self, name):
+		self.name = name
+		# sequence number of the next command expected
+		self.next = 0
+		# sequence number of the last command whose result was sent, maybe to a connection that was lost
+		self.acked = -1
+		# the last connection of the client, results go there
+		self.client = None
+		self.lock = asyncio.Lock()
+
+	def __str__(self):
+		return f"<Stream: {self.name}, {self.next} commands received, results up to {self.acked}>"
+
+	def send(self, obj):
+		if self.client is not None:
+			self.client.send(obj)
+
+class Hub:
+	""" the subscribers of one machine, by topic """
+	def __init__(self):
+		# the sets are never replaced, the send path keeps references to them
+		self.topics = {topic: set() for topic in TOPICS}
+
+	def __str__(self):
+		return f"<Hub: {', '.join(f'{t} {len(c)}' for t, c in self.topics.items())}>"
+
+	def wants(self, topic):
+		return bool(self.topics[topic])
+
+	def subscribe(self, client, topics):
+		for topic in topics:
+			if topic not in self.topics:
+				raise KeyError(f"no such topic: {topic} (one of {', '.join(TOPICS)})")
+		for topic in topics:
+			self.topics[topic].add(client)
+
+	def unsubscribe(self, client, topics = TOPICS):
+		for topic in topics:
+			self.topics[topic].discard(client)
+
+	def publish(self, topic, event):
+		""" `event` is encoded once for every subscriber """
+		line = encode({'event': topic, **event})
+		for client in list(self.topics[topic]):
+			if client.writer.is_closing():
+				self.unsubscribe(client)
+			else:
+				client.publish(line)
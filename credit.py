@@ -0,0 +1,201 @@
+import asyncio
+import logging
+from collections import deque
+from time import monotonic
+
+logger = logging.getLogger('stderrLogger')
+
+class CreditWindow:
+	"""
+		credit-based flow control driven by ADVANCED_OK replies (`ok P<n> B<n>`)
+
+		one credit is one free slot in the machine's command buffer: the writer
+		takes a credit for every command it sends and every `ok` gives it back.
+		each accounted reply sets `wakeup` so the writer runs right away instead
+		of polling.
+
+		recovery mode: credits get lost when an `ok` is missed or mangled on the
+		wire. the in-flight count is resynchronised when the machine reports
+		`wait` (its queue is empty, so nothing can be in flight) or when no reply
+		came back for `stall_timeout` seconds while the machine was not busy.
+
+		character counting (like Grbl's streaming protocol): if `rx_size` is set,
+		the bytes of unacknowledged commands are also tracked and a command is only
+		sent if it fits in what is left of the machine's RX buffer.
+	"""
+	def __init__(self, wakeup, limit = None, stall_timeout = 5, rx_size = None):
+		self.wakeup = wakeup
+		# None: machine not ready, set by the first `ok` (or ADVANCED_OK_WORKAROUND)
+		self.limit = limit
+		# user throttle (see `buffsize=`), never above `limit`
+		self.cap = None
+		self.in_flight = 0
+		self.rx_size = rx_size
+		# lengths and send times of the unacknowledged commands, oldest first
+		self.lengths = deque()
+		self.sent_at = deque()
+		# called with True when the command is acknowledged, False when it is given up by a recovery
+		self.on_ack = deque()
+		self.bytes_in_flight = 0
+		self.P, self.B = None, None
+		self.stall_timeout = stall_timeout
+		self.recoveries = 0
+		self.last_reply = monotonic()
+
+	def __str__(self):
+		return f"<CreditWindow: {self.in_flight}/{self.window} in flight ({self.bytes_in_flight}/{self.rx_size} bytes), P={self.P} B={self.B}, {self.recoveries} recoveries>"
+
+	@property
+	def window(self):
+		if self.limit is None:
+			return 0
+		return self.limit if self.cap is None else min(self.cap, self.limit)
+
+	@property
+	def free(self):
+		return max(0, self.window - self.in_flight)
+
+	def fits(self, length):
+		""" True if a command of `length` bytes fits in the machine's RX buffer """
+		if self.rx_size is None or not self.lengths:
+			# a command larger than the buffer is sent when nothing else is in flight
+			return True
+		return self.bytes_in_flight+length <= self.rx_size
+
+	def take(self, length = 0, on_ack = None):
+		""" account for a command of `length` bytes written to the machine (may overdraw, ie. for priority commands) """
+		self.in_flight += 1
+		self.lengths.append(length)
+		self.sent_at.append(monotonic())
+		self.on_ack.append(on_ack)
+		self.bytes_in_flight += length
+
+	def _release(self, keep, acked = True):
+		""" forget about the oldest commands in flight, keeping the `keep` most recent ones """
+		while len(self.lengths) > keep:
+			self.bytes_in_flight -= self.lengths.popleft()
+			self.sent_at.popleft()
+			if (on_ack := self.on_ack.popleft()) is not None:
+				on_ack(acked)
+
+	def ack(self, P = None, B = None):
+		"""
+			an `ok` was received ; P and B are None if they could not be extracted
+
+			returns how long ago the acknowledged command was sent (None if unknown)
+		"""
+		self.last_reply = monotonic()
+		latency = self.last_reply - self.sent_at[0] if self.sent_at else None
+		if P is not None:
+			self.P = P
+		if self.in_flight > 0:
+			self.in_flight -= 1
+		self._release(self.in_flight)
+		if B is not None:
+			self.B = B
+			if self.limit is None:
+				self.limit = B
+				logger.info(f"command buffer size set to {B}")
+			elif self.limit - B > self.in_flight:
+				# the machine holds more commands than we think we sent: we missed a `take()`
+				self.in_flight = self.limit - B
+		self.wakeup.set()
+		return latency
+
+	def touch(self):
+		""" the machine is alive but busy (`echo:busy: processing`, heating reports, ...) """
+		self.last_reply = monotonic()
+
+	def idle(self):
+		""" the machine reported `wait`: its command queue is empty """
+		self.last_reply = monotonic()
+		if self.in_flight > 0:
+			self.recover(0, 'wait')
+
+	def stalled(self):
+		""" True if commands are in flight and nothing came back for `stall_timeout` seconds """
+		return self.in_flight > 0 and monotonic() - self.last_reply > self.stall_timeout
+
+	def recover(self, in_flight = None, reason = 'stall'):
+		""" resynchronise the in-flight count, from the last reported `B` unless specified """
+		if in_flight is None:
+			in_flight = 0 if self.B is None or self.limit is None else max(0, self.limit - self.B)
+		logger.warning(f"credit recovery ({reason}): {self.in_flight} -> {in_flight} in flight ({self.P=}, {self.B=})")
+		self.in_flight = in_flight
+		self._release(in_flight, False)
+		self.recoveries += 1
+		self.last_reply = monotonic()
+		self.wakeup.set()
+
+
+class AdaptiveWindow:
+	"""
+		how many commands to keep in flight, adapted to ADVANCED_OK replies (GWiz)
+
+		the window starts at `initial` ; the largest P and B seen in the `ok`
+		replies are taken as the size of the planner and of the command buffer.
+		When the planner runs empty while commands are streamed, the host didn't
+		keep it fed and the window is doubled. When the planner is full and
+		commands take longer than `latency_target` to be acknowledged, they are
+		only waiting in the machine's buffers (pausing or aborting takes longer)
+		and the window shrinks by one. After a change the window is left alone
+		for as many replies as it holds.
+
+		it is never more than the command buffer plus `overcommit` commands
+		(they wait in the machine's RX buffer), never more than the user's cap
+		(see `buffsize`) and never less than 1. Without P and B it stays put.
+	"""
+	def __init__(self, initial = 5, latency_target = .5, overcommit = 2, smoothing = .1):
+		self.size = initial
+		self.cap = None
+		self.buffer = None
+		self.planner = None
+		self.overcommit = overcommit
+		# EWMA of the time between sending a command and its `ok` [s]
+		self.latency = None
+		self.latency_target = latency_target
+		self.smoothing = smoothing
+		self.hold = 0
+		self.grown = self.shrunk = 0
+
+	def __str__(self):
+		latency = '-' if self.latency is None else f"{self.latency*1000:.0f} ms"
+		return f"<AdaptiveWindow: {self.window} (cap {self.cap}, buffer {self.buffer}, planner {self.planner}), ack latency {latency}, grown {self.grown}x, shrunk {self.shrunk}x>"
+
+	@property
+	def window(self):
+		return self.size if self.cap is None else max(1, min(self.size, self.cap))
+
+	@property
+	def maximum(self):
+		return None if self.buffer is None else self.buffer+self.overcommit
+
+	def ack(self, P = None, B = None, latency = None, streaming = True):
+		"""
+			an `ok` ; P and B are None if not reported, `latency` [s] if the
+			acknowledged command is known, `streaming` is False while nothing is
+			being sent on purpose (paused, heating)
+		"""
+		if latency is not None:
+			self.latency = latency if self.latency is None else self.latency+self.smoothing*(latency-self.latency)
+		if B is not None and (self.buffer is None or B > self.buffer):
+			self.buffer = B
+			self.size = min(self.size, self.maximum)
+		if P is None:
+			return
+		if self.planner is None or P > self.planner:
+			self.planner = P
+		if self.hold > 0:
+			self.hold -= 1
+			return
+		if P >= self.planner and streaming and self.maximum is not None and self.size < self.maximum:
+			# starving
+			self.size = min(2*self.size, self.maximum)
+			self.grown += 1
+			self.hold = self.size
+			logger.debug(f"in-flight window grown to {self.size}")
+		elif P <= 1 and self.size > 1 and self.latency is not None and self.latency > self.latency_target:
+			self.size -= 1
+			self.shrunk += 1
+			self.hold = self.size
+			logger.debug(f"in-flight window shrunk to {self.size}")
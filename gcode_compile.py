@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+	ahead-of-time "compilation" of G-Code files
+
+	a compiled file (`.gwc`) holds the commands exactly as they are sent to the
+	machine (comments and blanks stripped, encoded, newline terminated) along with
+	their line number and byte offset in the source file, and flags for the
+	commands the sender cares about (job control, heating). It is memory-mapped
+	when loaded, so sending a command is a slice of the mapping: no per-line
+	string work is left on the send path.
+
+	layout (little-endian):
+		header	HEADER
+		arena	wire-ready commands, back to back
+		records	RECORD for every command, in file order
+
+	a compiled file next to its source (`part.gcode.gwc`) is reused as long as
+	the source's size, mtime and the encoding match, ie. across reprints.
+"""
+import asyncio
+import mmap
+import os
+import struct
+import logging
+import shutil
+import tempfile
+from bisect import bisect_left
+
+from gcode_source import iter_mmap_lines, gcode_lines, LineCursor, LINES_PER_YIELD
+
+logger = logging.getLogger('stderrLogger')
+
+MAGIC = b'GWZC'
+VERSION = 1
+SUFFIX = '.gwc'
+# magic, version, source size, source mtime (ns), command count, arena length, encoding
+HEADER = struct.Struct('<4sHxxQqQQ16s')
+# arena offset, source offset, source line number, length, flags
+RECORD = struct.Struct('<QQIHBx')
+
+FLAG_PRINT_START = 0x01	# M75
+FLAG_PRINT_PAUSE = 0x02	# M76
+FLAG_PRINT_STOP = 0x04	# M77
+FLAG_WAIT_HEAT = 0x08	# M109, M190, M191 (the machine won't ACK until it is hot)
+FLAGS = {
+	b'M75': FLAG_PRINT_START,
+	b'M76': FLAG_PRINT_PAUSE,
+	b'M77': FLAG_PRINT_STOP,
+	b'M109': FLAG_WAIT_HEAT,
+	b'M190': FLAG_WAIT_HEAT,
+	b'M191': FLAG_WAIT_HEAT,
+}
+
+class FormatError(Exception): pass
+
+def _is_utf8(encoding):
+	return encoding.lower().replace('-','').replace('_','') in ('utf8', 'ascii')
+
+def compile_line(line, encoding = 'utf8'):
+	"""
+		returns (wire, flags) for a raw source line, None for comments and blank lines
+
+		source files are assumed to be UTF-8 ; `encoding` is the one used on the wire
+	"""
+	cmd = line.split(b';',1)[0].strip()
+	if not cmd:
+		return None
+	if not _is_utf8(encoding):
+		cmd = cmd.decode().encode(encoding)
+	return cmd+b'\n', FLAGS.get(cmd.split(None,1)[0].upper(), 0)
+
+def compile_file(source, target = None, encoding = 'utf8'):
+	""" compiles `source` into `target` (defaults to the sidecar file), returns the target path """
+	if target is None:
+		target = source+SUFFIX
+	st = os.stat(source)
+	count = 0
+	arena_len = 0
+	tmp = target+'.tmp'
+	with open(source, 'rb') as src, open(tmp, 'wb') as out, tempfile.TemporaryFile() as records:
+		out.write(bytes(HEADER.size))
+		for lineno, (offset, line) in enumerate(iter_mmap_lines(src.fileno(), end=st.st_size)):
+			if (compiled := compile_line(line, encoding)) is None:
+				continue
+			wire, flags = compiled
+			records.write(RECORD.pack(arena_len, offset, lineno, len(wire), flags))
+			out.write(wire)
+			arena_len += len(wire)
+			count += 1
+		records.seek(0)
+		shutil.copyfileobj(records, out)
+		out.seek(0)
+		out.write(HEADER.pack(MAGIC, VERSION, st.st_size, st.st_mtime_ns, count, arena_len, encoding.encode()))
+	os.replace(tmp, target)
+	logger.info(f"compiled {source} into {target} ({count} commands, {arena_len} bytes)")
+	return target
+
+
+class CompiledGCode:
+	"""
+		read-only, memory-mapped view of a compiled G-Code file
+
+		indexing returns the wire-ready command (bytes, with its b'\\n'),
+		iterating yields (line number, source offset, flags, command)
+	"""
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if len(self._mm) < HEADER.size:
+			raise FormatError(f"{path} is too short")
+		magic, version, self.source_size, self.source_mtime_ns, self._count, arena_len, encoding = HEADER.unpack_from(self._mm)
+		if magic != MAGIC or version != VERSION:
+			raise FormatError(f"{path} is not a compiled G-Code file (version {VERSION})")
+		self.encoding = encoding.rstrip(b'\0').decode()
+		self._arena = HEADER.size
+		self._records = HEADER.size+arena_len
+		if len(self._mm) != self._records+self._count*RECORD.size:
+			raise FormatError(f"{path} is truncated")
+
+	def __str__(self):
+		return f"<CompiledGCode: {self.path} ({self._count} commands)>"
+
+	def __len__(self):
+		return self._count
+
+	def record(self, i):
+		""" (line number, source offset, flags, command) of the i-th command """
+		if i < 0:
+			i += self._count
+		if not 0 <= i < self._count:
+			raise IndexError(i)
+		arena_offset, offset, lineno, length, flags = RECORD.unpack_from(self._mm, self._records+i*RECORD.size)
+		start = self._arena+arena_offset
+		return lineno, offset, flags, self._mm[start:start+length]
+
+	def __getitem__(self, i):
+		return self.record(i)[3]
+
+	def iter_from(self, i = 0):
+		mm, arena = self._mm, self._arena
+		with memoryview(mm) as view:
+			for arena_offset, offset, lineno, length, flags in RECORD.iter_unpack(view[self._records+i*RECORD.size:]):
+				start = arena+arena_offset
+				yield lineno, offset, flags, mm[start:start+length]
+
+	def __iter__(self):
+		return self.iter_from(0)
+
+	def line_number(self, i):
+		return RECORD.unpack_from(self._mm, self._records+i*RECORD.size)[2]
+
+	def index_of_line(self, lineno):
+		""" index of the first command at or after source line `lineno` """
+		return bisect_left(range(self._count), lineno, key=self.line_number)
+
+	def is_fresh(self, source, encoding = 'utf8'):
+		""" True if this was compiled from `source` as it is now, with the same wire encoding """
+		try:
+			st = os.stat(source)
+		except OSError:
+			return False
+		return (st.st_size, st.st_mtime_ns, encoding) == (self.source_size, self.source_mtime_ns, self.encoding)
+
+	def close(self):
+		self._mm.close()
+
+
+class CompiledLines(LineCursor):
+	""" the commands of a CompiledGCode without their b'\\n', consumed from the head (GWiz piles) """
+	def __init__(self, compiled):
+		self.compiled = compiled
+
+	def __str__(self):
+		return f"<CompiledLines: {self.compiled.path} ({len(self)} commands)>"
+
+	def _count(self):
+		return len(self.compiled)
+
+	def _line(self, i):
+		return self.compiled[i][:-1]
+
+
+def load_or_compile(source, encoding = 'utf8'):
+	""" loads a `.gwc` file, or the up-to-date sidecar of a G-Code file (compiling it if needed) """
+	if source.endswith(SUFFIX):
+		return CompiledGCode(source)
+	sidecar = source+SUFFIX
+	try:
+		compiled = CompiledGCode(sidecar)
+	except (OSError, FormatError):
+		pass
+	else:
+		if compiled.is_fresh(source, encoding):
+			logger.info(f"reusing {sidecar}")
+			return compiled
+		compiled.close()
+	return CompiledGCode(compile_file(source, sidecar, encoding))
+
+async def records(source, encoding = 'utf8', follow = False, on_comment = None, start_line = 0, start_offset = 0):
+	"""
+		yields (line number, source offset, flags, command) from a CompiledGCode,
+		or from any source accepted by `gcode_source.gcode_lines()`, compiling on the fly
+
+		`start_line` and its byte offset `start_offset` skip the beginning of the file
+		(see resume_index.py) ; a CompiledGCode only needs `start_line`
+	"""
+	if isinstance(source, CompiledGCode):
+		for n, record in enumerate(source.iter_from(source.index_of_line(start_line))):
+			yield record
+			if not n % LINES_PER_YIELD:
+				await asyncio.sleep(0)
+		return
+	lineno = start_line-1
+	async for offset, line in gcode_lines(source, follow, start_offset):
+		lineno += 1
+		if (compiled := compile_line(line, encoding)) is not None:
+			yield lineno, offset, compiled[1], compiled[0]
+		elif on_comment is not None and line.startswith(b';'):
+			on_comment(line.strip().decode(errors='replace'))
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog="gcode_compile",
+		description=f"compiles G-Code files for gp and GWiz, the result is written next to the source (<file>{SUFFIX})",
+	)
+	parser.add_argument("gcode", help="G-Code file", metavar="file", nargs='+')
+	parser.add_argument("-e", "--encoding", default = 'utf8', type=str, help="encoding to use when sending to the machine (utf8)", metavar="str")
+	parser.add_argument("-o", "--out", default = None, help="output file (only with a single input file)", metavar="file")
+	args = parser.parse_args()
+
+	if args.out is not None and len(args.gcode) > 1:
+		parser.error("--out requires a single input file")
+	for gcode in args.gcode:
+		compiled = CompiledGCode(compile_file(gcode, args.out, args.encoding))
+		print(f"{compiled.path}: {len(compiled)} commands")
@@ -0,0 +1,203 @@
+import asyncio
+import mmap
+import os
+import stat
+import logging
+from array import array
+from threading import Thread
+
+logger = logging.getLogger('stderrLogger')
+
+# size of the mmap window on regular files, must be a multiple of mmap.ALLOCATIONGRANULARITY
+BLOCK_SIZE = 4*1024*1024
+# how often to check for new data when following a file (like `tail -f`)
+FOLLOW_INTERVAL = .5
+# give control back to the event loop every so many lines
+LINES_PER_YIELD = 1024
+# MappedLines publishes the line offsets by batches of
+INDEX_BATCH = 4096
+
+def iter_mmap_lines(fd, start = 0, end = None, block_size = BLOCK_SIZE, final = True):
+	"""
+		yields (offset, line) for every line of a regular file from `start` to `end`
+
+		the file is mapped one window at a time so memory use doesn't depend on the
+		file size ; lines keep their b'\\n'. With `final=False` an unterminated last
+		line is not yielded (it may still be being written).
+	"""
+	if end is None:
+		end = os.fstat(fd).st_size
+	line_start = pos = start
+	carry = b''
+	while pos < end:
+		base = pos - pos % mmap.ALLOCATIONGRANULARITY
+		length = min(block_size, end - base)
+		with mmap.mmap(fd, length, access=mmap.ACCESS_READ, offset=base) as mm:
+			if hasattr(mm, 'madvise'):
+				mm.madvise(mmap.MADV_SEQUENTIAL)
+			i = pos - base
+			while (j := mm.find(b'\n', i)) != -1:
+				yield line_start, carry + mm[i:j+1] if carry else mm[i:j+1]
+				carry = b''
+				i = j+1
+				line_start = base+i
+			carry += mm[i:]
+		pos = base+length
+	if carry and final:
+		yield line_start, carry
+
+async def _regular_file_lines(fd, follow, start = 0):
+	loop_count = 0
+	while True:
+		size = os.fstat(fd).st_size
+		if size < start:
+			logger.error(f"file was truncated ({size} < {start}), stopped following it")
+			return
+		for offset, line in iter_mmap_lines(fd, start, size, final=not follow):
+			start = offset+len(line)
+			yield offset, line
+			loop_count += 1
+			if not loop_count % LINES_PER_YIELD:
+				await asyncio.sleep(0)
+		if not follow:
+			return
+		await asyncio.sleep(FOLLOW_INTERVAL)
+
+async def _pipe_lines(fileobj):
+	loop = asyncio.get_running_loop()
+	reader = asyncio.StreamReader(limit=BLOCK_SIZE)
+	await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), fileobj)
+	offset = 0
+	while line := await reader.readline():
+		yield offset, line
+		offset += len(line)
+
+async def gcode_lines(source, follow = False, start = 0):
+	"""
+		yields (offset, line) from a G-Code file name or an open file/pipe (ie. stdin)
+
+		regular files are memory-mapped, pipes are read through an asyncio
+		StreamReader ; nothing is loaded upfront. With `follow`, a regular file
+		is kept open and new lines are yielded as they get appended (`tail -f`).
+		Regular files can be read from byte offset `start` (which must be the
+		start of a line), pipes can't.
+	"""
+	if isinstance(source, (str, bytes, os.PathLike)):
+		if stat.S_ISFIFO(os.stat(source).st_mode):
+			# a named pipe reads as EOF until it has a writer: the open waits for one (in a thread, not in the loop)
+			source = await asyncio.get_running_loop().run_in_executor(None, open, source, 'rb')
+		else:
+			fd = os.open(source, os.O_RDONLY)
+			if stat.S_ISREG(os.fstat(fd).st_mode):
+				try:
+					async for item in _regular_file_lines(fd, follow, start):
+						yield item
+				finally:
+					os.close(fd)
+				return
+			source = os.fdopen(fd, 'rb')
+	elif stat.S_ISREG(os.fstat(source.fileno()).st_mode):
+		# ie. `gp < file.gcode`
+		async for item in _regular_file_lines(source.fileno(), follow, start):
+			yield item
+		return
+
+	if start:
+		raise ValueError("can't seek in a pipe")
+	async for item in _pipe_lines(source):
+		yield item
+
+
+class LineCursor:
+	"""
+		read-only sequence of lines that are consumed from the head, like a deque
+		that is only ever `popleft()`ed ; subclasses provide `_count()` and `_line(i)`
+	"""
+	head = 0
+
+	def __len__(self):
+		return self._count()-self.head
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return [self._line(self.head+j) for j in range(*i.indices(len(self)))]
+		n = len(self)
+		if i < 0:
+			i += n
+		if not 0 <= i < n:
+			raise IndexError(f"{self} index out of range")
+		return self._line(self.head+i)
+
+	def __iter__(self):
+		return (self._line(i) for i in range(self.head, self._count()))
+
+	def popleft(self):
+		line = self[0]
+		self.head += 1
+		return line
+
+	def pop(self, i = 0):
+		if i != 0:
+			raise NotImplementedError("lines can only be taken from the head of a file")
+		return self.popleft()
+
+	def clear(self):
+		""" skips the lines that are left """
+		self.head = self._count()
+
+
+class MappedLines(LineCursor):
+	"""
+		the non-blank lines of a G-Code file, without loading the file
+
+		the file is memory-mapped and a thread records where every line starts ;
+		a line is only sliced out of the mapping when it is looked up (shown or
+		sent). The sequence grows while the file is being indexed, `on_progress`
+		is called (from the indexing thread) after every batch of lines.
+	"""
+	def __init__(self, path, on_progress = None):
+		self.path = path
+		self.offsets = array('Q')
+		self.indexed = False
+		self.on_progress = on_progress
+		with open(path, 'rb') as f:
+			self.size = os.fstat(f.fileno()).st_size
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+		if self._mm is not None and hasattr(self._mm, 'madvise'):
+			self._mm.madvise(mmap.MADV_SEQUENTIAL)
+		Thread(target=self._index, name=f"index {path}", daemon=True).start()
+
+	def __str__(self):
+		return f"<MappedLines: {self.path} ({len(self)} lines{'' if self.indexed else ', indexing'})>"
+
+	def _index(self):
+		mm, batch, i = self._mm, [], 0
+		while i < self.size:
+			if (j := mm.find(b'\n', i)) == -1:
+				j = self.size
+			if j > i:
+				batch.append(i)
+				if len(batch) == INDEX_BATCH:
+					self.offsets.extend(batch)
+					batch = []
+					if self.on_progress is not None:
+						self.on_progress()
+			i = j+1
+		self.offsets.extend(batch)
+		self.indexed = True
+		logger.info(f"indexed {self.path} ({len(self.offsets)} lines)")
+		if self.on_progress is not None:
+			self.on_progress()
+
+	def _count(self):
+		return len(self.offsets)
+
+	def _line(self, i):
+		start = self.offsets[i]
+		if (end := self._mm.find(b'\n', start)) == -1:
+			end = self.size
+		return self._mm[start:end].replace(b'\t', b' ')
+
+	def close(self):
+		if self._mm is not None:
+			self._mm.close()
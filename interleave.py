@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+	prints several G-Code files on one plate layer by layer instead of one after
+	the other (GWiz piles)
+
+	every file is scanned ahead of time (in a thread) for its layers, a layer
+	being what is extruded at one Z: a layer starts right after the last
+	extrusion of the layer below, so the layer change and travel moves of the
+	file belong to it. What comes before the first layer that isn't a move
+	(heating, homing, probing...) is the preamble of the file, what comes after
+	its last extrusion is its tail.
+
+	the preambles are sent first, one file after the other, then the layers of
+	all files, the lowest first (in file order for the same Z). Switching to
+	another file retracts, lifts above everything printed so far, travels to
+	where that file was, lowers, unretracts and restores its modes, extruder
+	position, fan and feedrate (the machine state of resume_index.py). Only the
+	tail of the last file to finish is sent.
+
+	a file can be cancelled at any time, the others go on.
+"""
+import logging
+from collections import deque
+from threading import Thread
+from time import sleep
+
+from resume_index import MachineState
+
+logger = logging.getLogger('stderrLogger')
+
+# between files
+RETRACT = 1.
+RETRACT_FEEDRATE = 2400
+Z_HOP = 1.
+Z_FEEDRATE = 600
+TRAVEL_FEEDRATE = 9000
+# smaller Z changes don't start a new layer (vase mode, noise in the file)
+MIN_LAYER_HEIGHT = .05
+MOVES = (b'G0', b'G1', b'G2', b'G3')
+
+class Part:
+	"""
+		one file being interleaved: `layers` is a list of (line, Z, MachineState
+		at that line), line numbers are positions in the file (not in the pile) ;
+		Z is None for a first layer extruded before any Z move
+	"""
+	def __init__(self, name, pile, order):
+		self.name = name
+		self.pile = pile
+		self.lines = getattr(pile, 'content', pile)
+		self.order = order
+		self.layers = []
+		self.preamble_end = self.tail = None
+		self.layer = 0
+		self.cancelled = False
+		self.scanned = False
+		Thread(target=self._scan, name=f"layers {name}", daemon=True).start()
+
+	def __str__(self):
+		state = 'cancelled' if self.cancelled else f"layer {self.layer}/{len(self.layers)}" if self.scanned else 'scanning'
+		return f"<Part: {self.name} ({state})>"
+
+	def _scan(self):
+		# MappedLines is still being indexed
+		while not getattr(self.lines, 'indexed', True):
+			sleep(.1)
+		state = MachineState()
+		head = self.lines.head
+		count = len(self.lines)+head
+		layer_z = None
+		# where the current run of non extruding lines starts, and the state there
+		after_extrusion, after_state = head, state.copy()
+		# end of the preamble so far: after the last command that isn't a move
+		setup_end, setup_state = head, state.copy()
+		for i in range(head, count):
+			cmd = self.lines._line(i).split(b';', 1)[0].strip().upper()
+			if not cmd:
+				continue
+			code = cmd.split(None, 1)[0]
+			e = state.e
+			state.update(cmd)
+			if code not in MOVES:
+				if not self.layers:
+					setup_end, setup_state = i+1, state.copy()
+				continue
+			if state.e <= e:
+				continue
+			# extrusion
+			if not self.layers:
+				self.preamble_end = setup_end
+				self.layers.append((setup_end, state.z, setup_state))
+				layer_z = state.z
+			elif state.z is not None and (layer_z is None or state.z > layer_z+MIN_LAYER_HEIGHT):
+				self.layers.append((after_extrusion, state.z, after_state))
+				layer_z = state.z
+			after_extrusion, after_state = i+1, state.copy()
+		self.tail = after_extrusion if self.layers else count
+		if self.preamble_end is None:
+			self.preamble_end = count
+		self.scanned = True
+		logger.info(f"{self.name}: {len(self.layers)} layers")
+
+	def remaining(self):
+		return 0 if self.cancelled else len(self.pile)
+
+
+class ZInterleaver:
+	"""
+		the interleaved G-Code files as a single pile: `len()` and `pop(0)` (the
+		commands between files are not in any pile)
+
+		`piles` is a dict {name: pile}, a pile being a LineCursor or a WQueue
+		whose `content` is a LineCursor ; commands are popped from the piles so
+		they show what is left of each file.
+	"""
+	def __init__(self, piles):
+		self.parts = [Part(name, pile, order) for order, (name, pile) in enumerate(piles.items())]
+		self.preambles = deque(self.parts)
+		self.pending = deque()
+		self.current = None
+		self.stop = 0
+		# highest Z printed so far
+		self.top = 0.
+
+	def __str__(self):
+		return f"<ZInterleaver: {', '.join(str(part) for part in self.parts)}>"
+
+	@property
+	def ready(self):
+		return all(part.scanned for part in self.parts)
+
+	def __len__(self):
+		if not self.ready:
+			return 0
+		return len(self.pending)+sum(part.remaining() for part in self.parts)
+
+	def pop(self, i = 0):
+		if i != 0:
+			raise NotImplementedError("commands can only be taken from the head")
+		while True:
+			if self.pending:
+				return self.pending.popleft()
+			part = self.current
+			if part is not None and not part.cancelled and part.lines.head < self.stop:
+				return part.pile.pop(0)
+			self._next_segment()
+
+	def _next_segment(self):
+		""" moves on to the next preamble, layer or tail ; IndexError when everything was sent """
+		while self.preambles:
+			part = self.preambles.popleft()
+			if not part.cancelled:
+				self.current, self.stop = part, part.preamble_end
+				return
+
+		part = self.current
+		left = [p for p in self.parts if not p.cancelled and p.layer < len(p.layers)]
+		if part is not None and not part.cancelled and part.layer == len(part.layers) and len(part.pile):
+			if not left:
+				# the last file to finish, its tail is sent
+				self.stop = part.lines.head+len(part.lines)
+				return
+			logger.info(f"{part.name}: done, its tail is skipped")
+			self.drop(part)
+		if not left:
+			raise IndexError("nothing left to interleave")
+
+		# a first layer extruded before any Z move has no Z, it goes first
+		part = min(left, key=lambda p: (p.layers[p.layer][1] is not None, p.layers[p.layer][1] or 0., p.order))
+		start, z, state = part.layers[part.layer]
+		if part is not self.current:
+			self.pending.extend(self.travel(part, state))
+		part.layer += 1
+		self.stop = part.layers[part.layer][0] if part.layer < len(part.layers) else part.tail
+		self.current = part
+		if z is not None:
+			self.top = max(self.top, z)
+
+	def travel(self, part, state):
+		""" the commands that leave the current file and resume `part` in `state` """
+		cmds = [f"; {part.name}: layer {part.layer+1}/{len(part.layers)}"]
+		if self.current is not None:
+			cmds += [
+				'G91',
+				f'G1 E-{RETRACT:g} F{RETRACT_FEEDRATE}',
+				'G90',
+				f'G0 Z{self.top+Z_HOP:g} F{Z_FEEDRATE}',
+			]
+			# before its first layer, the state of a file is the one after its preamble (ie. G28: X0 Y0 Z0,
+			# not a safe place to go) and the layer moves to where it starts by itself
+			if part.layer:
+				if state.x is not None and state.y is not None:
+					cmds.append(f'G0 X{state.x:g} Y{state.y:g} F{TRAVEL_FEEDRATE}')
+				if state.z is not None:
+					cmds.append(f'G0 Z{state.z:g} F{Z_FEEDRATE}')
+			cmds += [
+				'G91',
+				f'G1 E{RETRACT:g} F{RETRACT_FEEDRATE}',
+			]
+		cmds.append('G90' if state.absolute else 'G91')
+		cmds.append('M82' if state.e_absolute else 'M83')
+		cmds.append(f'G92 E{state.e:g}')
+		cmds.append(f'M106 S{state.fan}' if state.fan else 'M107')
+		if state.feedrate is not None:
+			cmds.append(f'G1 F{state.feedrate:g}')
+		return [bytes(cmd, 'ascii') for cmd in cmds]
+
+	def drop(self, part):
+		""" forgets what is left of `part` """
+		part.lines.clear()
+		if hasattr(part.pile, 'dirty'):
+			part.pile.dirty()
+
+	def cancel(self, name):
+		""" stops printing file `name` (or number, from 1) ; the others go on """
+		for part in self.parts:
+			if name in (part.name, str(part.order+1)):
+				part.cancelled = True
+				self.drop(part)
+				logger.info(f"{part.name} was cancelled")
+				return part
+		raise KeyError(name)
+
+
+if __name__ == '__main__':
+	import argparse
+	from gcode_source import MappedLines
+
+	parser = argparse.ArgumentParser(
+		prog="interleave",
+		description="prints G-Code files interleaved layer by layer, as GWiz sends them",
+	)
+	parser.add_argument("gcode", help="G-Code files", metavar="file", nargs='+')
+	parser.add_argument("--cancel", default = [], help="cancel this file (name or number) after `--after` commands", metavar="file", action='append')
+	parser.add_argument("--after", default = 0, type=int, help="when to cancel", metavar="int")
+	args = parser.parse_args()
+
+	interleaver = ZInterleaver({path: MappedLines(path) for path in args.gcode})
+	while not interleaver.ready:
+		sleep(.1)
+	sent = 0
+	while len(interleaver):
+		if sent == args.after:
+			for name in args.cancel:
+				print(f"; cancelled {interleaver.cancel(name).name}")
+		print(interleaver.pop(0).decode(errors='replace'))
+		sent += 1
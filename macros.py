@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+	macros defined in the machine config, expanded by gp and GWiz
+
+	one `macro=` line per macro, before `# G-Code starts here`:
+
+		macro=init:M104 S120|M140 S60|G34|M420 S1
+		macro=babystep(z:float):M290 Z{z}
+		macro=heat(hotend:int=200, bed:int=60):M104 S{hotend}|M140 S{bed}
+
+	commands are separated by `|` (`;` starts a comment), parameters are int,
+	float or str and may have a default. Every command is compiled once into
+	a byte template (`%` formatting) and the order of its arguments, so
+	expanding a macro only converts the arguments and fills the templates.
+
+	`@<name> <arguments>` runs a macro, the arguments by position or as
+	name=value ; a prefix of the name is enough if only one macro starts with
+	it (`@ba .25`). The names are kept sorted, a prefix is found by bisection.
+"""
+import re
+from bisect import bisect_left
+
+TYPES = {'int': int, 'float': float, 'str': str}
+SIGNATURE = re.compile(r'\s*([A-Za-z_][\w-]*)\s*(?:\((.*)\))?\s*$')
+FIELD = re.compile(r'\{(\w+)\}')
+
+class MacroError(ValueError): pass
+
+def _format(value):
+	# fixed-point: firmwares don't parse exponents, and %g rounds to 6 significant digits
+	return f"{value:.6f}".rstrip('0').rstrip('.').encode() if isinstance(value, float) else str(value).encode()
+
+class Macro:
+	def __init__(self, name, params, commands):
+		"""
+			`params`: [(name, type, default)], default is None when required ;
+			`commands`: G-Code lines with {name} fields
+		"""
+		self.name = name
+		self.params = params
+		self.index = {p[0]: i for i, p in enumerate(params)}
+		self.templates = []
+		for command in commands:
+			order = []
+			def field(match):
+				if match[1] not in self.index:
+					raise MacroError(f"{name}: unknown parameter {{{match[1]}}} in `{command}`")
+				order.append(self.index[match[1]])
+				return '%s'
+			# commands without fields are sent as they are, not %-formatted
+			template = FIELD.sub(field, command.replace('%', '%%')) if FIELD.search(command) else command
+			self.templates.append((template.encode()+b'\n', tuple(order)))
+
+	def __str__(self):
+		params = ', '.join(f"{n}:{t.__name__}" + ('' if d is None else f"={d.decode()}") for n, t, d in self.params)
+		return f"@{self.name}({params}): {len(self.templates)} commands"
+
+	def __len__(self):
+		return len(self.templates)
+
+	def bind(self, args):
+		""" the arguments (strings, by position or name=value) converted to their types """
+		values = [None]*len(self.params)
+		positional = 0
+		for arg in args:
+			name, eq, value = arg.partition('=')
+			if eq and name in self.index:
+				i = self.index[name]
+			else:
+				if eq and not value:
+					raise MacroError(f"@{self.name}: no parameter `{name}`")
+				i, value = positional, arg
+				positional += 1
+				if i >= len(self.params):
+					raise MacroError(f"@{self.name}: too many arguments ({self})")
+			kind = self.params[i][1]
+			try:
+				values[i] = _format(kind(value))
+			except ValueError:
+				raise MacroError(f"@{self.name}: {self.params[i][0]} must be {kind.__name__}, not `{value}`")
+		for i, (name, kind, default) in enumerate(self.params):
+			if values[i] is None:
+				if default is None:
+					raise MacroError(f"@{self.name}: missing {name} ({self})")
+				values[i] = default
+		return values
+
+	def expand(self, args = ()):
+		""" the commands (bytes, newline terminated) """
+		values = self.bind(args) if self.params else ()
+		return [template % tuple(values[i] for i in order) if order else template for template, order in self.templates]
+
+
+class Macros:
+	def __init__(self):
+		self.macros = {}
+		# sorted, for the prefix lookups
+		self.names = []
+
+	def __str__(self):
+		return f"<Macros: {', '.join(self.names)}>"
+
+	def __len__(self):
+		return len(self.macros)
+
+	def __iter__(self):
+		return (self.macros[name] for name in self.names)
+
+	def define(self, text):
+		""" a macro from the value of a `macro=` config line """
+		signature, colon, body = text.partition(':')
+		# the parameters have colons too
+		if '(' in signature and ')' not in signature:
+			params_end = text.find(')')
+			if params_end == -1:
+				raise MacroError(f"`{text}`: missing `)`")
+			signature, colon, body = text[:params_end+1], text[params_end+1:params_end+2], text[params_end+2:]
+		match = SIGNATURE.match(signature)
+		if not match or colon != ':':
+			raise MacroError(f"`{text}`: expected <name>[(<param>:<type>[=<default>], ...)]:<command>|<command>...")
+		name, params = match[1], []
+		for param in (match[2] or '').split(','):
+			if not param.strip():
+				continue
+			pname, _, rest = param.partition(':')
+			kind, _, default = rest.partition('=')
+			kind = kind.strip() or 'str'
+			if kind not in TYPES:
+				raise MacroError(f"{name}: unknown type `{kind}` (one of {', '.join(TYPES)})")
+			if default.strip():
+				try:
+					default = _format(TYPES[kind](default.strip()))
+				except ValueError:
+					raise MacroError(f"{name}: default of {pname.strip()} must be {kind}")
+			else:
+				default = None
+			params.append((pname.strip(), TYPES[kind], default))
+		commands = [c.split(';', 1)[0].strip() for c in body.split('|')]
+		macro = Macro(name, params, [c for c in commands if c])
+		if name not in self.macros:
+			self.names.insert(bisect_left(self.names, name), name)
+		self.macros[name] = macro
+		return macro
+
+	def lookup(self, prefix):
+		""" the macro named `prefix`, or the only one whose name starts with it """
+		if (macro := self.macros.get(prefix)) is not None:
+			return macro
+		i = bisect_left(self.names, prefix)
+		found = []
+		while i < len(self.names) and self.names[i].startswith(prefix) and len(found) < 2:
+			found.append(self.names[i])
+			i += 1
+		if not found:
+			raise MacroError(f"no macro @{prefix}")
+		if len(found) > 1:
+			raise MacroError(f"@{prefix} is ambiguous: {', '.join(n for n in self.names if n.startswith(prefix))}")
+		return self.macros[found[0]]
+
+	def expand(self, text):
+		""" `@<name> <arguments>` (or without @) -> (macro, commands) """
+		if not (words := text.strip().lstrip('@').split()):
+			raise MacroError(f"which one? {', '.join(self.names)}")
+		name, *args = words
+		macro = self.lookup(name)
+		return macro, macro.expand(args)
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog="macros",
+		description="lists the macros of a machine config, or shows what a macro expands to",
+	)
+	parser.add_argument("config", help="machine config", metavar="file")
+	parser.add_argument("macro", help="@<name> <arguments>", metavar="text", nargs='*')
+	args = parser.parse_args()
+
+	macros = Macros()
+	with open(args.config) as f:
+		for line in f:
+			if line == '# G-Code starts here\n':
+				break
+			if line.startswith('macro='):
+				macros.define(line[6:].rstrip('\n'))
+	if args.macro:
+		macro, commands = macros.expand(' '.join(args.macro))
+		for command in commands:
+			print(command.decode(), end='')
+	else:
+		for macro in macros:
+			print(macro)
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+	what the machine replies, parsed once into typed events (gp and GWiz)
+
+	`parse(line)` takes a raw line (bytes, with or without its terminator) and
+	returns one of the events below ; the first byte picks the parser, the
+	rest is done with bytes.split() and precompiled patterns, nothing is
+	decoded. Events are immutable, the ones of the usual `ok P<n> B<n>` are
+	cached. Every event
+	keeps the line as received (`line`, stripped) for logging and display.
+
+	- Ack: `ok`, with P (free planner slots) and B (free command buffer slots)
+	  with ADVANCED_OK, the line number (N) and the temperatures of `ok T:...`
+	- Temperature: `T:189.79 /198.00 B:31.18 /70.00 @:127 B@:127 W:?`, every
+	  heater as label: (temperature, target), powers by heater label, W
+	- Position: `X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0`
+	- Busy: `echo:busy: processing` (and `paused for user`...)
+	- Wait: `wait`, the machine is idle
+	- UnknownCommand: `echo:Unknown command: "G999"`
+	- Echo, Comment (`//...`), Error, Resend
+	- Other: anything else (`start`, `pages_ready`...)
+
+	run it to time it against the startswith chains it replaces, on recorded
+	reply streams (one reply per line) or on a synthetic one.
+"""
+import re
+from collections import namedtuple
+from resend_window import parse_resend
+
+Ack = namedtuple('Ack', 'line P B N temperature')
+Temperature = namedtuple('Temperature', 'line heaters powers W')
+Position = namedtuple('Position', 'line axes text')
+Busy = namedtuple('Busy', 'line reason')
+Wait = namedtuple('Wait', 'line')
+UnknownCommand = namedtuple('UnknownCommand', 'line command')
+Echo = namedtuple('Echo', 'line text')
+Comment = namedtuple('Comment', 'line text')
+Error = namedtuple('Error', 'line text')
+Resend = namedtuple('Resend', 'line N')
+Other = namedtuple('Other', 'line')
+_new = tuple.__new__
+
+# without line numbers there are only a few different `ok P<n> B<n>`, their events are reused
+ACK_CACHE = 1024
+ACKS = {}
+
+AXIS = re.compile(rb'([A-Z]):(-?\d+(?:\.\d*)?)')
+UNKNOWN_COMMAND = re.compile(rb'echo:Unknown command:\s*"([^"]*)"')
+
+def parse_temperature(line):
+	heaters, powers, W = {}, {}, None
+	heater = None
+	try:
+		for field in line.split():
+			if field[0] == 47:	# /target of the heater before
+				if heater is not None:
+					heaters[heater] = (heaters[heater][0], float(field[1:]))
+				continue
+			label, _, value = field.partition(b':')
+			heater = None
+			if not value:
+				continue
+			if label == b'W':
+				# residency countdown [s], `?` while the target isn't reached
+				W = value
+			elif b'@' in label:
+				# @ and @0 are the hotends (T, T0), B@ the bed
+				name, _, n = label.partition(b'@')
+				powers[name or b'T'+n] = int(value)
+			elif value[0] != 40:	# not a raw ADC value `(4095)`
+				heater = label
+				heaters[label] = (float(value), None)
+	except ValueError:
+		# line noise, keep what could be read
+		pass
+	return _new(Temperature, (line, heaters, powers, W))
+
+def _ok(line):
+	if line[:3] not in (b'ok', b'ok '):
+		return Other(line)
+	P = B = N = temperature = None
+	for field in line[3:].split():
+		c = field[0]
+		try:
+			if c == 80:		# P
+				P = int(field[1:])
+			elif c == 66:	# B
+				B = int(field[1:])
+			elif c == 78:	# N
+				N = int(field[1:])
+			elif c == 84:	# T: (M105)
+				temperature = parse_temperature(line[3:])
+				break
+		except ValueError:
+			# line noise, what's missing is None
+			pass
+	# tuple.__new__ skips the argument handling of namedtuple.__new__ (about half the time of an event)
+	event = _new(Ack, (line, P, B, N, temperature))
+	if N is None and temperature is None and len(ACKS) < ACK_CACHE:
+		ACKS[line] = event
+	return event
+
+def _temperature(line):
+	if line[1:2] != b':' and line[2:3] != b':':
+		return Other(line)
+	return parse_temperature(line)
+
+def _position(line):
+	if line[1:2] != b':':
+		return Other(line)
+	text = line.split(b' Count ', 1)[0]
+	return _new(Position, (line, {axis: float(value) for axis, value in AXIS.findall(text)}, text))
+
+def _echo(line):
+	if line[:5] != b'echo:':
+		return Other(line)
+	if line[5:11] == b'busy: ':
+		return _new(Busy, (line, line[11:]))
+	if line[5:21] == b'Unknown command:':
+		m = UNKNOWN_COMMAND.match(line)
+		return UnknownCommand(line, m[1] if m else line[21:].strip())
+	return Echo(line, line[5:])
+
+def _busy(line):
+	return Busy(line, line[6:]) if line[:6] == b'busy: ' else Other(line)
+
+def _comment(line):
+	return Comment(line, line[2:]) if line[1:2] == b'/' else Other(line)
+
+def _error(line):
+	return Error(line, line[6:]) if line[:6] == b'Error:' else Other(line)
+
+def _resend(line):
+	n = parse_resend(line)
+	return Other(line) if n is None else Resend(line, n)
+
+def _wait(line):
+	return _new(Wait, (line,)) if line == b'wait' else Other(line)
+
+# first byte -> parser
+DISPATCH = [Other]*256
+for first, parser in {
+		b'o': _ok, b'T': _temperature, b'B': _temperature, b'X': _position, b'e': _echo, b'b': _busy,
+		b'/': _comment, b'E': _error, b'R': _resend, b'r': _resend, b'w': _wait,
+	}.items():
+	DISPATCH[first[0]] = parser
+
+def parse(line):
+	""" the event for one line received from the machine """
+	line = line.strip()
+	if (event := ACKS.get(line)) is not None:
+		return event
+	if not line:
+		return Other(line)
+	return DISPATCH[line[0]](line)
+
+
+if __name__ == '__main__':
+	import argparse
+	import random
+	from time import perf_counter
+
+	parser = argparse.ArgumentParser(
+		prog="marlin_replies",
+		description="times the reply parser on recorded reply streams (one reply per line)",
+	)
+	parser.add_argument("replies", help="recorded replies (synthetic stream by default)", metavar="file", nargs='*')
+	parser.add_argument("-n", "--lines", default = 200_000, type=int, help="size of the synthetic stream", metavar="int")
+	args = parser.parse_args()
+
+	def startswith_chain(reply):
+		# what gp.serial_read (and GWiz.read_from_serial) did with every reply
+		reply = reply.decode(errors='replace').strip()
+		if reply.startswith('ok'):
+			fields = reply.split(' ')[1:]
+			try:
+				return int(fields[0].lstrip('P')), int(fields[1].lstrip('B'))
+			except (ValueError, IndexError):
+				return None
+		elif reply.startswith('echo:busy: processing'):
+			return reply
+		elif reply.startswith(('T:', 'X:')):
+			W = next((t[2:] for t in reply.split() if t.startswith('W:')), None)
+			# and what GWiz did with the temperatures
+			temps = reply.split(' ')
+			for t in range(len(temps)//3):
+				try:
+					label, temp = temps[2*t].split(':')
+					target = float(temps[2*t+1].lstrip('/'))
+					pwr = int(temps[2*len(temps)//3+t].split(':')[1])
+				except (ValueError, IndexError):
+					pass
+			return W
+		elif reply.startswith(('echo', '//')):
+			return reply.startswith('echo:Unknown command:')
+		elif reply == 'wait':
+			return reply
+		elif (n := parse_resend(reply)) is not None:
+			return n
+		return reply.startswith('Error:')
+
+	def synthetic(lines, seed = 0):
+		rnd = random.Random(seed)
+		stream = []
+		for i in range(lines):
+			r = rnd.random()
+			if r < .9:
+				stream.append(b'ok P%d B%d\n' % (rnd.randrange(16), rnd.randrange(4)))
+			elif r < .96:
+				stream.append(b'T:%.2f /210.00 B:%.2f /60.00 @:%d B@:%d W:?\n' % (rnd.uniform(20, 210), rnd.uniform(20, 60), rnd.randrange(128), rnd.randrange(128)))
+			elif r < .98:
+				stream.append(b'echo:busy: processing\n')
+			elif r < .99:
+				stream.append(b'X:%.2f Y:%.2f Z:%.2f E:0.00 Count X:0 Y:0 Z:0\n' % (rnd.uniform(0, 200), rnd.uniform(0, 200), rnd.uniform(0, 10)))
+			else:
+				stream.append(rnd.choice((b'wait\n', b'echo:Unknown command: "G999"\n', b'Resend: 12\n', b'//action:notification\n')))
+		return stream
+
+	streams = {'synthetic': synthetic(args.lines)}
+	for path in args.replies:
+		with open(path, 'rb') as f:
+			streams[path] = f.readlines()
+
+	for name, stream in streams.items():
+		times = []
+		for f in (startswith_chain, parse):
+			start = perf_counter()
+			for line in stream:
+				f(line)
+			times.append((perf_counter()-start)/len(stream)*1e9)
+		kinds = {}
+		for line in stream:
+			kind = type(parse(line)).__name__
+			kinds[kind] = kinds.get(kind, 0)+1
+		print(f"{name}: {len(stream)} replies ({', '.join(f'{k} {v}' for k, v in kinds.items())})")
+		print(f"  startswith chain {times[0]:8.1f} ns/reply")
+		print(f"  parse()          {times[1]:8.1f} ns/reply")
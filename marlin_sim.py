@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+"""
+	simulated Marlin firmware on a pseudo-terminal, for benchmarking gp and GWiz
+
+	the host connects to the pty's slave end (printed on startup) as if it were
+	the machine's serial port. What is emulated:
+
+	- `start` on startup, `ok P<n> B<n>` (ADVANCED_OK) for every command
+	- a command buffer (BUFSIZE, `B`) and a planner (BLOCK_BUFFER_SIZE, `P`)
+	  that executes one move every `move_time` seconds ; G28 takes `home_time`
+	- `wait` when idle and `echo:busy: processing` while a command blocks
+	  (HOST_KEEPALIVE_FEATURE)
+	- heating: M104/M140 set targets, M109/M190 block and report `T:... W:<n>`
+	  every second until the target is reached, M105 and M155 auto-reports
+	- `echo:Unknown command: "..."` for anything that isn't a G, M or T code
+	- line numbers and checksums (`N<n> ...*<cs>`), M110, `Error:` and `Resend:`
+	- optional line corruption (`corrupt` is the probability a line is garbled)
+
+	statistics (commands/s, planner starvation, host turnaround) are kept in
+	`stats` for benchmark.py.
+"""
+import asyncio
+import os
+import re
+import tty
+import random
+import logging
+from time import monotonic
+from functools import reduce
+from operator import xor
+
+logger = logging.getLogger('stderrLogger')
+
+MOVES = (b'G0', b'G1', b'G2', b'G3', b'G5')
+CODE = re.compile(rb'^[GMT]\d+$')
+KEEPALIVE_INTERVAL = 2
+AMBIENT = 25.
+
+class Heater:
+	def __init__(self, label, rate):
+		self.label = label
+		self.rate = rate
+		self.temp = AMBIENT
+		self.target = 0.
+		self._t = monotonic()
+
+	def update(self):
+		now = monotonic()
+		dt, self._t = now-self._t, now
+		goal = max(self.target, AMBIENT)
+		step = self.rate*dt
+		self.temp = min(goal, self.temp+step) if self.temp < goal else max(goal, self.temp-step)
+
+	@property
+	def power(self):
+		return 127 if self.target and self.temp < self.target else 0
+
+	@property
+	def reached(self):
+		return self.temp >= self.target-1
+
+
+class MarlinSim:
+	def __init__(self, planner_size = 16, buffer_size = 4, move_time = .002, home_time = .5,
+			heat_rate = 100., corrupt = 0., advanced_ok = True, seed = None):
+		self.planner_size = planner_size
+		self.buffer_size = buffer_size
+		self.move_time = move_time
+		self.home_time = home_time
+		self.corrupt = corrupt
+		self.advanced_ok = advanced_ok
+		self.random = random.Random(seed)
+		self.heaters = {b'T': Heater(b'T', heat_rate), b'B': Heater(b'B', heat_rate/4)}
+		self.autoreport = 0
+		self.last_n = 0
+
+		self.master, slave = os.openpty()
+		tty.setraw(slave)
+		self.port = os.ttyname(slave)
+		# keep the slave open so the pty survives hosts disconnecting
+		self._slave = slave
+		self._rx = b''
+		self._reading = False
+		# received commands ; past `buffer_size` they stand for what waits in the RX buffer
+		self.commands = None
+		self.planner = 0
+		self._planner_not_full = None
+		self._planner_not_empty = None
+		self._planner_empty = None
+		self.busy = False
+		self.stats = {
+			'lines': 0,		# lines received
+			'commands': 0,		# commands executed
+			'timed_commands': 0,	# commands executed since the first move
+			'moves': 0,
+			'unknown': 0,
+			'corrupted': 0,
+			'resends': 0,
+			'first': None,		# first move and last command (monotonic)
+			'last': None,
+			'starved_seconds': 0.,	# planner empty between two moves
+			'turnaround': [],	# ok sent with an empty command buffer while moving -> next line received [s]
+		}
+		self._starved_since = None
+		self._ok_sent_idle = None
+
+	def __str__(self):
+		return f"<MarlinSim: {self.port}, planner {self.planner}/{self.planner_size}, buffer {self.buffer_size-self.free_buffer}/{self.buffer_size}>"
+
+	@property
+	def free_buffer(self):
+		return max(0, self.buffer_size-self.commands.qsize())
+
+	def send(self, line):
+		os.write(self.master, line+b'\n')
+
+	def ok(self, extra = b''):
+		if self.advanced_ok:
+			self.send(b'ok P%d B%d%s' % (self.planner_size-self.planner, self.free_buffer, extra))
+		else:
+			self.send(b'ok'+extra)
+		if self.commands.empty() and self.planner:
+			# the host is now all that keeps the planner from running dry
+			self._ok_sent_idle = monotonic()
+
+	def temperatures(self, wait = None):
+		T, B = self.heaters[b'T'], self.heaters[b'B']
+		for heater in (T, B):
+			heater.update()
+		report = b'T:%.2f /%.2f B:%.2f /%.2f @:%d B@:%d' % (T.temp, T.target, B.temp, B.target, T.power, B.power)
+		if wait is not None:
+			report += b' W:%s' % wait
+		return report
+
+	"""
+		serial side
+	"""
+	def _readable(self):
+		try:
+			data = os.read(self.master, 4096)
+		except OSError:
+			return
+		self._rx += data
+		while b'\n' in self._rx:
+			line, self._rx = self._rx.split(b'\n', 1)
+			self._received(line.rstrip(b'\r'))
+		if self.commands.qsize() >= self.buffer_size:
+			# like a full RX buffer: the rest stays on the wire until there is room
+			asyncio.get_running_loop().remove_reader(self.master)
+			self._reading = False
+
+	def _received(self, line):
+		now = monotonic()
+		self.stats['lines'] += 1
+		if self._ok_sent_idle is not None:
+			self.stats['turnaround'].append(now-self._ok_sent_idle)
+			self._ok_sent_idle = None
+		if self.corrupt and line and self.random.random() < self.corrupt:
+			i = self.random.randrange(len(line))
+			line = line[:i]+bytes([line[i] ^ 1 << self.random.randrange(7)])+line[i+1:]
+			self.stats['corrupted'] += 1
+		if line[:1] == b'N':
+			line = self._check_line(line)
+			if line is None:
+				return
+		line = line.split(b';', 1)[0].strip()
+		if line[:4].upper() == b'M110':
+			# handled when received, so that the next line numbers are checked against it
+			try:
+				self.last_n = int(line.split(b'N', 1)[1].split()[0])
+			except (IndexError, ValueError):
+				self.last_n = 0
+		if line:
+			self.commands.put_nowait(line)
+
+	def _check_line(self, line):
+		""" returns the command without line number and checksum, None if it was rejected """
+		try:
+			numbered, cs = line.rsplit(b'*', 1)
+			n = int(numbered[1:].split(None, 1)[0])
+			cmd = numbered.split(None, 1)[1] if b' ' in numbered else b''
+			valid = int(cs) == reduce(xor, numbered, 0)
+		except ValueError:
+			numbered, n, cmd, valid = line, None, b'', False
+		if not valid:
+			return self._reject(b'checksum mismatch')
+		if cmd[:4].upper() == b'M110':
+			return cmd
+		if n != self.last_n+1:
+			return self._reject(b'Line Number is not Last Line Number+1')
+		self.last_n = n
+		return cmd
+
+	def _reject(self, error):
+		self.stats['resends'] += 1
+		self.send(b'Error:%s, Last Line: %d' % (error, self.last_n))
+		self.send(b'Resend: %d' % (self.last_n+1))
+		self.ok()
+		return None
+
+	"""
+		firmware side
+	"""
+	async def _planner(self):
+		while True:
+			await self._planner_not_empty.wait()
+			while self.planner:
+				await asyncio.sleep(self.move_time)
+				self.planner -= 1
+				self.stats['moves'] += 1
+				self._planner_not_full.set()
+			self._planner_not_empty.clear()
+			self._planner_empty.set()
+			self._starved_since = monotonic()
+
+	async def _plan(self, blocks = 1):
+		for _ in range(blocks):
+			while self.planner >= self.planner_size:
+				self._planner_not_full.clear()
+				await self._planner_not_full.wait()
+			if not self.planner and self._starved_since is not None:
+				self.stats['starved_seconds'] += monotonic()-self._starved_since
+				self._starved_since = None
+			self.planner += 1
+			self._planner_empty.clear()
+			self._planner_not_empty.set()
+
+	async def _keepalive(self):
+		while True:
+			await asyncio.sleep(KEEPALIVE_INTERVAL)
+			if self.busy:
+				self.send(b'echo:busy: processing')
+			elif self.commands.empty():
+				self.send(b'wait')
+
+	async def _autoreport(self):
+		while True:
+			await asyncio.sleep(self.autoreport or 1)
+			if self.autoreport:
+				self.send(self.temperatures())
+
+	async def _heat(self, heater):
+		self.busy = True
+		while not heater.reached:
+			self.send(self.temperatures(b'?'))
+			await asyncio.sleep(1)
+		self.send(self.temperatures(b'0'))
+		self.busy = False
+
+	async def _execute(self, cmd):
+		code, _, params = cmd.partition(b' ')
+		code = code.upper()
+		if not CODE.match(code):
+			self.stats['unknown'] += 1
+			self.send(b'echo:Unknown command: "%s"' % cmd)
+			return
+		words = {w[:1].upper(): w[1:] for w in params.split()}
+		if code in MOVES:
+			if self.stats['first'] is None:
+				self.stats['first'] = monotonic()
+			await self._plan()
+		elif code == b'G28':
+			self.busy = True
+			await self._planner_empty.wait()
+			await asyncio.sleep(self.home_time)
+			self.busy = False
+		elif code in (b'G4', b'M400'):
+			await self._planner_empty.wait()
+			if code == b'G4' and (delay := words.get(b'P') or words.get(b'S')):
+				await asyncio.sleep(float(delay)/(1000 if b'P' in words else 1))
+		elif code in (b'M104', b'M109', b'M140', b'M190'):
+			heater = self.heaters[b'T' if code in (b'M104', b'M109') else b'B']
+			if b'S' in words:
+				heater.target = float(words[b'S'])
+			if code in (b'M109', b'M190'):
+				await self._heat(heater)
+		elif code == b'M105':
+			return b' '+self.temperatures()
+		elif code == b'M155':
+			self.autoreport = int(float(words.get(b'S', b'0')))
+
+	async def _firmware(self):
+		while True:
+			cmd = await self.commands.get()
+			extra = await self._execute(cmd) or b''
+			self.stats['commands'] += 1
+			if self.stats['first'] is not None:
+				self.stats['timed_commands'] += 1
+			self.stats['last'] = monotonic()
+			if not self._reading and self.commands.qsize() < self.buffer_size:
+				# there's room again
+				asyncio.get_running_loop().add_reader(self.master, self._readable)
+				self._reading = True
+			self.ok(extra)
+
+	async def run(self):
+		self.commands = asyncio.Queue()
+		self._planner_not_full = asyncio.Event()
+		self._planner_not_empty = asyncio.Event()
+		self._planner_empty = asyncio.Event()
+		self._planner_empty.set()
+		asyncio.get_running_loop().add_reader(self.master, self._readable)
+		self._reading = True
+		self.send(b'start')
+		try:
+			await asyncio.gather(self._planner(), self._firmware(), self._keepalive(), self._autoreport())
+		finally:
+			# before the pty is closed, or the selector would keep a stale entry for its fd
+			asyncio.get_running_loop().remove_reader(self.master)
+
+	def summary(self):
+		""" the statistics that matter for benchmarks """
+		stats = self.stats
+		span = (stats['last']-stats['first']) if stats['first'] is not None and stats['last'] != stats['first'] else 0
+		turnaround = sorted(stats['turnaround'])
+		def percentile(p):
+			return turnaround[min(len(turnaround)-1, int(p*len(turnaround)))] if turnaround else None
+		return {
+			'commands': stats['commands'],
+			'moves': stats['moves'],
+			'seconds': span,
+			'commands_per_second': stats['timed_commands']/span if span else 0.,
+			'starvation_ratio': stats['starved_seconds']/span if span else 0.,
+			'turnaround_p50': percentile(.5),
+			'turnaround_p95': percentile(.95),
+			'unknown': stats['unknown'],
+			'corrupted': stats['corrupted'],
+			'resends': stats['resends'],
+		}
+
+	def close(self):
+		for fd in (self.master, self._slave):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+
+if __name__ == '__main__':
+	import argparse
+	import signal
+
+	parser = argparse.ArgumentParser(
+		prog="marlin_sim",
+		description="simulated Marlin firmware on a pseudo-terminal ; connect gp or GWiz to the printed port",
+	)
+	parser.add_argument("--planner", default = 16, type=int, help="planner size (BLOCK_BUFFER_SIZE)", metavar="int")
+	parser.add_argument("--buffer", default = 4, type=int, help="command buffer size (BUFSIZE)", metavar="int")
+	parser.add_argument("--move-time", default = .002, type=float, help="time to execute one move [s]", metavar="float")
+	parser.add_argument("--home-time", default = .5, type=float, help="time to home [s]", metavar="float")
+	parser.add_argument("--heat-rate", default = 100., type=float, help="hotend heating rate [°C/s]", metavar="float")
+	parser.add_argument("--corrupt", default = 0., type=float, help="probability that a received line gets corrupted", metavar="float")
+	parser.add_argument("--no-advanced-ok", action='store_true', help="plain `ok` replies")
+	parser.add_argument("--seed", default = None, type=int, help="random seed", metavar="int")
+	args = parser.parse_args()
+
+	def stop(signum, frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM, stop)
+
+	sim = MarlinSim(args.planner, args.buffer, args.move_time, args.home_time, args.heat_rate, args.corrupt, not args.no_advanced_ok, args.seed)
+	print(sim.port, flush=True)
+	try:
+		asyncio.run(sim.run())
+	except KeyboardInterrupt:
+		pass
+	finally:
+		for key, value in sim.summary().items():
+			print(f"{key}: {value}")
+		sim.close()
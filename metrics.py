@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+from bisect import bisect_left
+from collections import deque
+from time import monotonic, time
+
+logger = logging.getLogger('stderrLogger')
+
+# ack latency buckets [s]
+LATENCY_BUCKETS = (.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, 10, 30)
+# planner (P) and command buffer (B) free slots
+OCCUPANCY_BUCKETS = (0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 64)
+# rates are averaged over this many seconds
+RATE_WINDOW = 10
+# exported as Prometheus counters, everything else is a gauge
+COUNTERS = ('commands_sent', 'bytes_sent', 'writes', 'acks', 'starvation_events', 'heating_seconds')
+
+class Histogram:
+	""" cumulative histogram with fixed upper bounds (Prometheus style) """
+	def __init__(self, bounds):
+		self.bounds = bounds
+		# the last one is +Inf
+		self.counts = [0]*(len(bounds)+1)
+		self.sum = 0
+		self.count = 0
+
+	def observe(self, value):
+		self.counts[bisect_left(self.bounds, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def cumulative(self):
+		total = 0
+		for bound, count in zip((*self.bounds, '+Inf'), self.counts):
+			total += count
+			yield bound, total
+
+	def as_dict(self):
+		return {'buckets': {str(bound): total for bound, total in self.cumulative()}, 'sum': self.sum, 'count': self.count}
+
+
+class Metrics:
+	"""
+		host-side performance counters for gp
+
+		the send path only adds to a few counters (once per write) and every
+		`ok` feeds the histograms ; rates are computed from samples taken every
+		second by `run()`. `gauges` maps names to callables that are read when
+		the metrics are exported (queue depths, ...).
+	"""
+	def __init__(self, gauges = None):
+		self.started = monotonic()
+		self.commands_sent = 0
+		self.bytes_sent = 0
+		self.writes = 0
+		self.acks = 0
+		self.starvation_events = 0
+		self.heating_seconds = 0.
+		self._heating_since = None
+		self.ack_latency = Histogram(LATENCY_BUCKETS)
+		self.planner_free = Histogram(OCCUPANCY_BUCKETS)
+		self.buffer_free = Histogram(OCCUPANCY_BUCKETS)
+		self.gauges = {} if gauges is None else gauges
+		self._samples = deque([(monotonic(), 0, 0)], maxlen=RATE_WINDOW+1)
+
+	def sent(self, commands, length):
+		""" one write of `commands` commands, `length` bytes """
+		self.commands_sent += commands
+		self.bytes_sent += length
+		self.writes += 1
+
+	def ack(self, latency, P, B):
+		""" an `ok` ; any of the arguments may be None """
+		self.acks += 1
+		if latency is not None:
+			self.ack_latency.observe(latency)
+		if P is not None:
+			self.planner_free.observe(P)
+		if B is not None:
+			self.buffer_free.observe(B)
+
+	def starving(self):
+		self.starvation_events += 1
+
+	def heating(self, heating):
+		""" the machine started (True) or stopped (False) heating """
+		if heating and self._heating_since is None:
+			self._heating_since = monotonic()
+		elif not heating and self._heating_since is not None:
+			self.heating_seconds += monotonic()-self._heating_since
+			self._heating_since = None
+
+	def rates(self):
+		""" (commands/s, bytes/s) over the last RATE_WINDOW seconds """
+		(t0, c0, b0), (t1, c1, b1) = self._samples[0], (monotonic(), self.commands_sent, self.bytes_sent)
+		if t1 <= t0:
+			return 0., 0.
+		return (c1-c0)/(t1-t0), (b1-b0)/(t1-t0)
+
+	async def run(self):
+		""" background task: samples the counters for the rates """
+		while True:
+			await asyncio.sleep(1)
+			self._samples.append((monotonic(), self.commands_sent, self.bytes_sent))
+
+	def snapshot(self):
+		commands_rate, bytes_rate = self.rates()
+		heating = self.heating_seconds
+		if self._heating_since is not None:
+			heating += monotonic()-self._heating_since
+		return {
+			'time': time(),
+			'uptime_seconds': monotonic()-self.started,
+			'commands_sent': self.commands_sent,
+			'bytes_sent': self.bytes_sent,
+			'writes': self.writes,
+			'acks': self.acks,
+			'commands_per_second': commands_rate,
+			'bytes_per_second': bytes_rate,
+			'starvation_events': self.starvation_events,
+			'heating_seconds': heating,
+			**{name: gauge() for name, gauge in self.gauges.items()},
+			'ack_latency_seconds': self.ack_latency.as_dict(),
+			'planner_free_slots': self.planner_free.as_dict(),
+			'buffer_free_slots': self.buffer_free.as_dict(),
+		}
+
+	def json(self):
+		""" one JSON line """
+		return json.dumps(self.snapshot())+'\n'
+
+	def prometheus(self, labels = ''):
+		""" Prometheus text exposition format ; `labels` ie. 'machine="killerwhale"' """
+		snapshot = self.snapshot()
+		lines = []
+		def braces(*extra):
+			return '{'+','.join(l for l in (labels, *extra) if l)+'}'
+		for name, value in snapshot.items():
+			if name == 'time' or isinstance(value, dict):
+				continue
+			if name in COUNTERS:
+				lines.append(f"# TYPE gp_{name}_total counter")
+				lines.append(f"gp_{name}_total{braces()} {value}")
+			else:
+				lines.append(f"# TYPE gp_{name} gauge")
+				lines.append(f"gp_{name}{braces()} {0 if value is None else float(value)}")
+		for name, histogram in (('ack_latency_seconds', self.ack_latency), ('planner_free_slots', self.planner_free), ('buffer_free_slots', self.buffer_free)):
+			lines.append(f"# TYPE gp_{name} histogram")
+			for bound, total in histogram.cumulative():
+				le = f'le="{bound}"'
+				lines.append(f"gp_{name}_bucket{braces(le)} {total}")
+			lines.append(f"gp_{name}_sum{braces()} {histogram.sum}")
+			lines.append(f"gp_{name}_count{braces()} {histogram.count}")
+		return '\n'.join(lines)+'\n'
+
+
+async def serve_http(metrics, port, labels = ''):
+	""" minimal HTTP endpoint for scrapers: /metrics (Prometheus) and /metrics.json """
+	async def handle(reader, writer):
+		try:
+			request = await reader.readline()
+			# skip the headers
+			while (await reader.readline()).strip():
+				pass
+			path = request.split()[1] if len(request.split()) > 1 else b'/'
+			if path == b'/metrics.json':
+				body, content_type = metrics.json(), 'application/json'
+			else:
+				body, content_type = metrics.prometheus(labels), 'text/plain; version=0.0.4'
+			body = body.encode()
+			writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\n\r\n%s' % (content_type.encode(), len(body), body))
+			await writer.drain()
+		except (ConnectionError, asyncio.IncompleteReadError) as e:
+			logger.info(f"metrics request failed: {e}")
+		finally:
+			writer.close()
+
+	server = await asyncio.start_server(handle, '0.0.0.0', port)
+	logger.info(f"metrics available on port {port}")
+	async with server:
+		await server.serve_forever()
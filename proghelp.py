@@ -21,8 +21,10 @@ G-Wiz makes it possible to alter parameters such as feedrate, extrusion ratio an
 
 Usage notes:
 - When searching for a command and only one choice remains, that command is automatically typed for you
+- 'page up' and 'page down' scroll through the 'ack' pile history (older entries are kept on disk, see `--ack-history`)
 - In command mode, the right panel (here) shows command usage and parameters for the typed command (TODO)
-- at the time of this writing, multiple gcodes are executed sequentially (no interpolation)
+- multiple gcodes are executed sequentially, or layer by layer with `-z` (`--interleave`) ; `cancel <file>` stops one of them, the others go on
+- `@<macro> [<arguments>]` runs a macro of the machine config (`macro=` lines, see macros.py) ; a prefix of its name is enough
 """
 
 BANNER="""[38;5;129m [39m[38;5;129m [39m[38;5;93m [39m[38;5;93m [39m[38;5;93m [39m[38;5;93m [39m[38;5;93m╻[39m[38;5;93m [39m[38;5;93m╻[39m[38;5;93m [39m[38;5;93m [39m[38;5;99m [39m[38;5;63m [39m[38;5;63m [39m[38;5;63m [39m[38;5;63m┏[39m[38;5;63m━[39m[38;5;63m╸[39m[38;5;63m [39m[38;5;63m [39m[38;5;63m [39m[38;5;63m┏[39m[38;5;63m━[39m[38;5;69m╸[39m[38;5;33m┏[39m[38;5;33m━[39m[38;5;33m┓[39m[38;5;33m╺[39m[38;5;33m┳[39m[38;5;33m┓[39m[38;5;33m┏[39m[38;5;33m━[39m[38;5;33m╸[39m[38;5;39m [39m[38;5;39m [39m[38;5;39m [39m[38;5;39m╻[39m[38;5;39m [39m[38;5;39m╻[39m[38;5;39m╻[39m[38;5;39m╺[39m[38;5;39m━[39m[38;5;38m┓[39m[38;5;38m┏[39m[38;5;44m━[39m[38;5;44m┓[39m[38;5;44m┏[39m[38;5;44m━[39m[38;5;44m┓[39m[38;5;44m╺[39m[38;5;44m┳[39m[38;5;44m┓[39m[38;5;44m [39m[38;5;44m [39m[38;5;43m [39m[38;5;49m [39m[38;5;49m [39m[38;5;49m [39m[38;5;49m╻[39m[38;5;49m [39m[38;5;49m╻[39m[38;5;49m [39m[38;5;49m [39m[38;5;49m [39m[38;5;49m[39m
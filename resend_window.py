@@ -0,0 +1,99 @@
+import logging
+from collections import deque
+from functools import reduce
+from operator import xor
+from time import monotonic
+
+logger = logging.getLogger('stderrLogger')
+
+def checksum(data):
+	""" RepRap checksum: XOR of all the bytes before the '*' """
+	return reduce(xor, data, 0)
+
+class ResendWindow:
+	"""
+		reliable transmission: line numbers, checksums and resends
+
+		`frame()` turns a command into `N<line> <command>*<checksum>\\n` and keeps
+		it in a bounded history, so that a `Resend: <line>` (or `rs <line>`) from
+		the machine can be honoured with `resend()`. `M110` (set line number) is
+		sent as-is and restarts the numbering.
+
+		after a transmission error Marlin flushes its RX buffer and asks for the
+		same line again for every line that was still on the wire: the
+		repetitions of a request we already honoured are swallowed.
+	"""
+	def __init__(self, size = 256):
+		self.sent = deque(maxlen=size)
+		self.next_n = 1
+		self.resend_times = deque()
+		self._swallow_n, self._swallow_count = None, 0
+
+	def __str__(self):
+		return f"<ResendWindow: next N{self.next_n}, {len(self.sent)} lines kept, {self.resends_per_minute} resends/min>"
+
+	def frame(self, cmd):
+		""" frames a command (with or without its b'\\n') ; returns the line to send """
+		cmd = cmd.rstrip(b'\n')
+		if cmd[:4] == b'M110':
+			# the machine expects N+1 next, don't number this one
+			try:
+				n = int(cmd.split(b'N',1)[1].split()[0])
+			except (IndexError, ValueError):
+				n = 0
+			self.sent.clear()
+			self.next_n = n+1
+			return cmd+b'\n'
+		line = b'N%d %s' % (self.next_n, cmd)
+		line = b'%s*%d\n' % (line, checksum(line))
+		self.sent.append(line)
+		self.next_n += 1
+		return line
+
+	def length(self, cmd):
+		""" length of `cmd` once framed, without framing it (the checksum is counted with 3 digits) """
+		cmd = cmd.rstrip(b'\n')
+		if cmd[:4] == b'M110':
+			return len(cmd)+1
+		# N<line> <command>*<checksum>\n
+		return len(cmd)+len(str(self.next_n))+7
+
+	def resend(self, n):
+		"""
+			returns the lines to send again, starting at line `n`
+
+			empty if this is a repetition of a request that was already honoured ;
+			raises KeyError if line `n` is not in the history anymore
+		"""
+		if n == self._swallow_n and self._swallow_count:
+			self._swallow_count -= 1
+			return []
+		first = self.next_n-len(self.sent)
+		if not first <= n < self.next_n:
+			raise KeyError(f"line {n} is not in the resend window (N{first}..N{self.next_n-1})")
+		lines = list(self.sent)[n-first:]
+		self._swallow_n, self._swallow_count = n, len(lines)-1
+		self.resend_times.append(monotonic())
+		logger.info(f"resending {len(lines)} lines from N{n}")
+		return lines
+
+	@property
+	def resends_per_minute(self):
+		now = monotonic()
+		while self.resend_times and now-self.resend_times[0] > 60:
+			self.resend_times.popleft()
+		return len(self.resend_times)
+
+
+def parse_resend(reply):
+	""" line number from a `Resend: <n>` or `rs <n>` reply (bytes or str), None otherwise """
+	if reply[:7] in ('Resend:', b'Resend:'):
+		value = reply[7:]
+	elif reply[:3] in ('rs ', b'rs '):
+		value = reply[3:]
+	else:
+		return None
+	try:
+		return int(value.split()[0].lstrip('N' if isinstance(value, str) else b'N'))
+	except (IndexError, ValueError):
+		return None
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+	checkpointed machine state for resuming prints (see `resume_on_crash` in gp)
+
+	a single streaming pass over a G-Code file records, every CHECKPOINT_INTERVAL
+	lines, the machine state the file has set up so far (position, extruder
+	position, absolute/relative modes, feedrate, fan and temperatures) along with
+	the line's byte offset. The index is saved next to the file (`part.gcode.gwr`).
+
+	resuming at line L is then a seek to the last checkpoint before L and a replay
+	of at most CHECKPOINT_INTERVAL lines to get the exact state, from which the
+	preamble (heat up, re-home XY, restore modes and positions) is generated.
+"""
+import os
+import re
+import json
+import logging
+from collections import deque
+
+from gcode_source import iter_mmap_lines
+
+logger = logging.getLogger('stderrLogger')
+
+SUFFIX = '.gwr'
+VERSION = 1
+CHECKPOINT_INTERVAL = 1000
+# how high to lift the nozzle above the print while re-homing XY
+Z_LIFT = 5
+
+WORD = re.compile(rb'([A-Z])\s*([-+]?\d*\.?\d+)')
+FIELDS = ('x', 'y', 'z', 'e', 'absolute', 'e_absolute', 'feedrate', 'fan', 'hotend', 'bed')
+
+class MachineState:
+	""" what the G-Code has set up on the machine so far """
+	__slots__ = FIELDS
+
+	def __init__(self, *values):
+		# firmware defaults after a reboot
+		for field, value in zip(FIELDS, values or (None, None, None, 0., True, True, None, 0, None, None)):
+			setattr(self, field, value)
+
+	def copy(self):
+		return MachineState(*self.values())
+
+	def values(self):
+		return [getattr(self, field) for field in FIELDS]
+
+	def __repr__(self):
+		return '<MachineState: '+' '.join(f"{field}={getattr(self, field)}" for field in FIELDS)+'>'
+
+	def update(self, line):
+		""" applies a raw G-Code line (bytes) """
+		cmd = line.split(b';',1)[0].strip().upper()
+		if not cmd:
+			return
+		code = cmd.split(None,1)[0]
+		if code in (b'G0', b'G1', b'G2', b'G3'):
+			for letter, value in WORD.findall(cmd[len(code):]):
+				value = float(value)
+				if letter == b'F':
+					self.feedrate = value
+				elif letter == b'E':
+					self.e = value if self.e_absolute else self.e+value
+				elif letter in b'XYZ':
+					axis = letter.decode().lower()
+					current = getattr(self, axis)
+					setattr(self, axis, value if self.absolute or current is None else current+value)
+		elif code == b'G90':
+			self.absolute = self.e_absolute = True
+		elif code == b'G91':
+			self.absolute = self.e_absolute = False
+		elif code == b'M82':
+			self.e_absolute = True
+		elif code == b'M83':
+			self.e_absolute = False
+		elif code == b'G92':
+			for letter, value in WORD.findall(cmd[3:]):
+				if letter in b'XYZE':
+					setattr(self, letter.decode().lower(), float(value))
+		elif code == b'G28':
+			axes = [letter for letter in b'XYZ' if bytes([letter]) in cmd[3:]] or list(b'XYZ')
+			for letter in axes:
+				setattr(self, chr(letter).lower(), 0.)
+		elif code in (b'M104', b'M109', b'M140', b'M190', b'M106'):
+			for letter, value in WORD.findall(cmd[len(code):]):
+				if letter == b'S':
+					if code == b'M106':
+						self.fan = int(float(value))
+					elif code in (b'M104', b'M109'):
+						self.hotend = float(value)
+					else:
+						self.bed = float(value)
+		elif code == b'M107':
+			self.fan = 0
+
+	def preamble(self):
+		""" the commands that bring a freshly rebooted machine back to this state """
+		cmds = []
+		if self.bed:
+			cmds.append(f'M140 S{self.bed:g}')
+		if self.hotend:
+			cmds.append(f'M104 S{self.hotend:g}')
+		if self.bed:
+			cmds.append(f'M190 S{self.bed:g}')
+		if self.hotend:
+			cmds.append(f'M109 S{self.hotend:g}')
+		cmds.append('G90')
+		if self.z is not None:
+			# the nozzle is still where the machine crashed
+			cmds.append(f'G92 Z{self.z:g}')
+			cmds.append(f'G0 Z{self.z+Z_LIFT:g}')
+		cmds.append('G28 XY')
+		if self.x is not None and self.y is not None:
+			cmds.append(f'G0 X{self.x:g} Y{self.y:g}')
+		if self.z is not None:
+			cmds.append(f'G0 Z{self.z:g}')
+		cmds.append('G90' if self.absolute else 'G91')
+		cmds.append('M82' if self.e_absolute else 'M83')
+		cmds.append(f'G92 E{self.e:g}')
+		cmds.append(f'M106 S{self.fan}' if self.fan else 'M107')
+		if self.feedrate is not None:
+			cmds.append(f'G1 F{self.feedrate:g}')
+		return [bytes(cmd, 'ascii')+b'\n' for cmd in cmds]
+
+
+def build_index(source, interval = CHECKPOINT_INTERVAL):
+	""" one pass over `source`, returns the index (a dict, as saved in the sidecar file) """
+	st = os.stat(source)
+	state = MachineState()
+	checkpoints = []
+	with open(source, 'rb') as f:
+		for lineno, (offset, line) in enumerate(iter_mmap_lines(f.fileno(), end=st.st_size)):
+			if not lineno % interval:
+				checkpoints.append([lineno, offset, *state.values()])
+			state.update(line)
+	return {
+		'version': VERSION,
+		'source_size': st.st_size,
+		'source_mtime_ns': st.st_mtime_ns,
+		'interval': interval,
+		'checkpoints': checkpoints,
+	}
+
+def load_or_build(source):
+	""" returns the index of `source`, from its sidecar file if it is up to date """
+	sidecar = source+SUFFIX
+	st = os.stat(source)
+	try:
+		with open(sidecar) as f:
+			index = json.load(f)
+		if (index['version'], index['source_size'], index['source_mtime_ns']) == (VERSION, st.st_size, st.st_mtime_ns):
+			return index
+	except (OSError, ValueError, KeyError):
+		pass
+	index = build_index(source)
+	with open(sidecar+'.tmp', 'w') as f:
+		json.dump(index, f)
+	os.replace(sidecar+'.tmp', sidecar)
+	logger.info(f"built resume index {sidecar} ({len(index['checkpoints'])} checkpoints)")
+	return index
+
+def resume_point(source, lineno, backtrack = 0):
+	"""
+		where and how to resume printing `source` at line `lineno`
+
+		`backtrack` commands before `lineno` are sent again (they were in the
+		machine's planner buffer and were lost in the crash). Returns
+		(preamble, line number, byte offset): the commands to send first, then
+		the file from that line/offset.
+	"""
+	index = load_or_build(source)
+	checkpoints = index['checkpoints']
+	lo, hi = 0, len(checkpoints)
+	while lo < hi:
+		mid = (lo+hi)//2
+		if checkpoints[mid][0] <= lineno:
+			lo = mid+1
+		else:
+			hi = mid
+	if not lo:
+		return MachineState().preamble(), 0, 0
+
+	# replay from the checkpoint, keeping the state before each of the last `backtrack` commands ;
+	# start from an earlier checkpoint if there aren't enough commands in between
+	for start, offset, *values in reversed(checkpoints[:lo]):
+		state = MachineState(*values)
+		recent = deque(maxlen=backtrack)
+		with open(source, 'rb') as f:
+			for n, (line_offset, line) in enumerate(iter_mmap_lines(f.fileno(), offset), start):
+				if n >= lineno:
+					break
+				if backtrack and line.split(b';',1)[0].strip():
+					recent.append((n, line_offset, state.copy()))
+				state.update(line)
+			else:
+				line_offset = os.stat(source).st_size
+		if len(recent) == backtrack:
+			break
+	if recent:
+		n, line_offset, state = recent[0]
+	else:
+		n = lineno
+	return state.preamble(), n, line_offset
+
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		prog="resume_index",
+		description=f"builds the resume index of G-Code files (<file>{SUFFIX}), or shows how a print would be resumed",
+	)
+	parser.add_argument("gcode", help="G-Code file", metavar="file", nargs='+')
+	parser.add_argument("-L", "--line", default = None, type=int, help="show the preamble to resume at this line", metavar="int")
+	parser.add_argument("-B", "--backtrack", default = 0, type=int, help="number of commands to send again before that line", metavar="int")
+	args = parser.parse_args()
+
+	for gcode in args.gcode:
+		if args.line is None:
+			print(f"{gcode}: {len(load_or_build(gcode)['checkpoints'])} checkpoints")
+		else:
+			preamble, lineno, offset = resume_point(gcode, args.line, args.backtrack)
+			print(f"; resuming {gcode} at line {lineno} (offset {offset})")
+			for cmd in preamble:
+				print(cmd.decode(), end='')
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+	search index of the command descriptions (GWiz search mode)
+
+	the descriptions are split in trigrams once, when the machine config is
+	loaded ; a search term of three characters or more only checks the entries
+	that have all its trigrams, shorter terms check the candidates left by the
+	other terms. As characters are typed the previous result is narrowed
+	instead of searching again, results are kept for backspace and so are the
+	highlighted descriptions.
+
+	matching is case-sensitive and every term must appear in the description,
+	like it always was.
+"""
+from functools import lru_cache
+
+# number of searches kept (for backspace)
+RESULT_CACHE = 64
+
+def trigrams(text):
+	return {text[i:i+3] for i in range(len(text)-2)}
+
+class CommandIndex:
+	def __init__(self, commands):
+		""" `commands`: {command: description} """
+		self.commands = list(commands)
+		self.descriptions = [commands[c] for c in self.commands]
+		self.postings = {}
+		for i, desc in enumerate(self.descriptions):
+			for trigram in trigrams(desc):
+				self.postings.setdefault(trigram, set()).add(i)
+		self.everything = range(len(self.commands))
+		self.results = {(): self.everything}
+		self.last = ()
+		self.markup = lru_cache(maxsize=1024)(self._markup)
+
+	def __repr__(self):
+		return f"<CommandIndex: {len(self.commands)} commands, {len(self.postings)} trigrams, {len(self.results)} searches cached>"
+
+	def __len__(self):
+		return len(self.commands)
+
+	def _narrows(self, needles):
+		""" True if every term of the last search is part of one of `needles` """
+		return all(any(old in new for new in needles) for old in self.last)
+
+	def search(self, text):
+		""" ids (in config order) of the commands whose description holds every word of `text` """
+		needles = tuple(sorted({n for n in text.split(' ') if n}, key=len, reverse=True))
+		if (found := self.results.get(needles)) is None:
+			candidates = self.results[self.last] if self._narrows(needles) else self.everything
+			for needle in needles:
+				if len(needle) >= 3:
+					postings = [self.postings.get(t, ()) for t in trigrams(needle)]
+					candidates = set(candidates).intersection(*postings)
+				candidates = [i for i in candidates if needle in self.descriptions[i]]
+			found = sorted(candidates)
+			if len(self.results) >= RESULT_CACHE:
+				del self.results[next(k for k in self.results if k)]
+			self.results[needles] = found
+		self.last = needles
+		return found
+
+	def _markup(self, i, needles):
+		"""
+			the description of command `i` as urwid text markup, the parts that
+			match one of `needles` highlighted (alternating HL1 and HL0)
+		"""
+		desc = self.descriptions[i]
+		spans = []
+		for needle in needles:
+			start = desc.find(needle)
+			while start != -1:
+				spans.append((start, start+len(needle)))
+				start = desc.find(needle, start+1)
+		if not spans:
+			return desc
+		spans.sort()
+		merged = [list(spans[0])]
+		for start, stop in spans[1:]:
+			if start <= merged[-1][1]:
+				merged[-1][1] = max(merged[-1][1], stop)
+			else:
+				merged.append([start, stop])
+		markup, pos = [], 0
+		for j, (start, stop) in enumerate(merged):
+			if start > pos:
+				markup.append(desc[pos:start])
+			markup.append(('HL0' if j%2 else 'HL1', desc[start:stop]))
+			pos = stop
+		if pos < len(desc):
+			markup.append(desc[pos:])
+		return markup
+
+	def highlight(self, i, text):
+		return self.markup(i, tuple(n for n in text.split(' ') if n))
+
+
+if __name__ == '__main__':
+	import argparse
+	from time import perf_counter
+
+	parser = argparse.ArgumentParser(
+		prog="search_index",
+		description="searches the command descriptions of a GWiz machine config",
+	)
+	parser.add_argument("config", help="machine config", metavar="file")
+	parser.add_argument("terms", help="what to search for, typed one character at a time", metavar="text")
+	args = parser.parse_args()
+
+	commands = {}
+	with open(args.config) as f:
+		for line in f:
+			if line == '# G-Code starts here\n':
+				break
+		for line in f:
+			if not line.startswith('#') and '=' in line:
+				command, desc = line.rstrip('\n').split('=', 1)
+				commands[command] = desc
+
+	start = perf_counter()
+	index = CommandIndex(commands)
+	print(f"{index} built in {(perf_counter()-start)*1000:.2f} ms")
+	for n in range(1, len(args.terms)+1):
+		start = perf_counter()
+		found = index.search(args.terms[:n])
+		print(f"{args.terms[:n]!r:24} {len(found):4} results in {(perf_counter()-start)*1e6:8.1f} µs")
+	for i in found:
+		print(f"{index.commands[i]:8}{index.highlight(i, args.terms)}")
@@ -0,0 +1,228 @@
+import asyncio
+import os
+import logging
+from collections import deque
+
+import serial
+
+logger = logging.getLogger('stderrLogger')
+
+class SerialTransport(asyncio.Transport):
+	"""
+		asyncio transport on top of an open pyserial port (POSIX only)
+
+		the port's file descriptor is switched to non-blocking mode and handed to
+		the loop's reader/writer callbacks: reading never waits for a full line and
+		writing never waits for the UART, whatever is left is written when the
+		descriptor becomes writable again.
+	"""
+	max_read_size = 4096
+
+	def __init__(self, loop, protocol, ser):
+		super().__init__(extra={'serial': ser})
+		self._loop = loop
+		self._protocol = protocol
+		self._ser = ser
+		self._fd = ser.fileno()
+		os.set_blocking(self._fd, False)
+		self._write_buffer = bytearray()
+		self._writing = False
+		self._closing = False
+		self._reading = True
+		self._protocol_paused = False
+		self.set_write_buffer_limits()
+		loop.call_soon(protocol.connection_made, self)
+		loop.call_soon(loop.add_reader, self._fd, self._read_ready)
+
+	def _read_ready(self):
+		try:
+			data = os.read(self._fd, self.max_read_size)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			# EIO when the device goes away (USB re-enumeration, CPU reboot)
+			self._fatal_error(e)
+			return
+		if data:
+			self._protocol.data_received(data)
+		else:
+			self._fatal_error(ConnectionResetError(f"EOF on {self._ser.port}"))
+
+	def write(self, data):
+		if self._closing:
+			return
+		if not self._write_buffer:
+			try:
+				n = os.write(self._fd, data)
+			except (BlockingIOError, InterruptedError):
+				n = 0
+			except OSError as e:
+				self._fatal_error(e)
+				return
+			if n == len(data):
+				return
+			data = data[n:]
+		self._write_buffer += data
+		if not self._writing:
+			self._loop.add_writer(self._fd, self._write_ready)
+			self._writing = True
+		self._maybe_pause_protocol()
+
+	def _write_ready(self):
+		try:
+			n = os.write(self._fd, self._write_buffer)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError as e:
+			self._fatal_error(e)
+			return
+		del self._write_buffer[:n]
+		if not self._write_buffer:
+			self._loop.remove_writer(self._fd)
+			self._writing = False
+			if self._closing:
+				self._call_connection_lost(None)
+		self._maybe_resume_protocol()
+
+	def can_write_eof(self):
+		return False
+
+	def get_write_buffer_size(self):
+		return len(self._write_buffer)
+
+	def set_write_buffer_limits(self, high = None, low = None):
+		self._high_water = 64*1024 if high is None else high
+		self._low_water = self._high_water//4 if low is None else low
+
+	def _maybe_pause_protocol(self):
+		if not self._protocol_paused and self.get_write_buffer_size() > self._high_water:
+			self._protocol_paused = True
+			self._protocol.pause_writing()
+
+	def _maybe_resume_protocol(self):
+		if self._protocol_paused and self.get_write_buffer_size() <= self._low_water:
+			self._protocol_paused = False
+			self._protocol.resume_writing()
+
+	def pause_reading(self):
+		if self._reading:
+			self._loop.remove_reader(self._fd)
+			self._reading = False
+
+	def resume_reading(self):
+		if not self._reading and not self._closing:
+			self._loop.add_reader(self._fd, self._read_ready)
+			self._reading = True
+
+	def is_reading(self):
+		return self._reading
+
+	def is_closing(self):
+		return self._closing
+
+	def close(self):
+		if self._closing:
+			return
+		self._closing = True
+		self.pause_reading()
+		if not self._write_buffer:
+			self._loop.call_soon(self._call_connection_lost, None)
+
+	def abort(self):
+		self._write_buffer.clear()
+		self._fatal_error(None)
+
+	def _fatal_error(self, exc):
+		if exc is not None:
+			logger.error(f"serial transport: {exc}")
+		self._closing = True
+		self.pause_reading()
+		if self._writing:
+			self._loop.remove_writer(self._fd)
+			self._writing = False
+		self._write_buffer.clear()
+		self._loop.call_soon(self._call_connection_lost, exc)
+
+	def _call_connection_lost(self, exc):
+		if self._ser is None:
+			return
+		try:
+			self._protocol.connection_lost(exc)
+		finally:
+			self._ser.close()
+			self._ser = None
+
+
+class SerialLink(asyncio.Protocol):
+	"""
+		line-oriented protocol for SerialTransport
+
+		incoming bytes are split into lines as they arrive (partial lines are
+		kept until their newline shows up) and handed out by `readline()`,
+		outgoing writes are queued in the transport and never block.
+	"""
+	def __init__(self):
+		self.transport = None
+		self._partial = bytearray()
+		self._lines = deque()
+		self._line_ready = asyncio.Event()
+		self._can_write = asyncio.Event()
+		self._can_write.set()
+		self._lost = None
+
+	def connection_made(self, transport):
+		self.transport = transport
+
+	def data_received(self, data):
+		self._partial += data
+		if b'\n' not in data:
+			return
+		*lines, rest = self._partial.split(b'\n')
+		self._partial = bytearray(rest)
+		self._lines.extend(map(bytes, lines))
+		self._line_ready.set()
+
+	def connection_lost(self, exc):
+		self._lost = exc or serial.serialutil.SerialException("serial port closed")
+		self._line_ready.set()
+		self._can_write.set()
+
+	def pause_writing(self):
+		self._can_write.clear()
+
+	def resume_writing(self):
+		self._can_write.set()
+
+	async def readline(self):
+		""" next line received from the machine, without its line terminator """
+		while not self._lines:
+			if self._lost is not None:
+				raise serial.serialutil.SerialException(self._lost)
+			self._line_ready.clear()
+			await self._line_ready.wait()
+		return self._lines.popleft().rstrip(b'\r')
+
+	def write(self, data):
+		if self._lost is not None:
+			raise serial.serialutil.SerialException(self._lost)
+		self.transport.write(data)
+
+	async def drain(self):
+		""" wait until the transport's write buffer is below its low-water mark """
+		await self._can_write.wait()
+		if self._lost is not None:
+			raise serial.serialutil.SerialException(self._lost)
+
+	def close(self):
+		if self.transport is not None:
+			self.transport.close()
+
+
+async def open_serial_connection(ser, protocol_factory = SerialLink):
+	""" wraps an open `serial.Serial` into a SerialTransport, returns its protocol """
+	loop = asyncio.get_running_loop()
+	protocol = protocol_factory()
+	SerialTransport(loop, protocol, ser)
+	# let connection_made() run
+	await asyncio.sleep(0)
+	return protocol
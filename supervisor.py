@@ -0,0 +1,194 @@
+"""
+	one gp worker process per core for large printer farms (gp --workers)
+
+	the machines are dealt out to the workers, which each run the usual event
+	loop for their share (forked, so they inherit the parsed configs). G-Code
+	files are compiled before forking and the workers memory-map the compiled
+	files, so every file is in memory once whatever the number of machines
+	printing it.
+
+	every machine keeps its own TCP port ; the supervisor listens on one more
+	port and routes `<machine> <command>` (`go`, `pause`, `buffsize=`, G-Code...)
+	to the machine, whichever worker owns it. `all <command>` goes to every
+	machine, `workers` answers one JSON line per worker (process state and the
+	metrics of its machines added up) and `metrics` one line for the farm.
+	The replies of a machine come back prefixed with its name.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+logger = logging.getLogger('stderrLogger')
+
+# how often the metrics of every machine are collected [s]
+HEALTH_INTERVAL = 5
+# added up per worker and for the farm
+SUMMED = ('commands_sent', 'bytes_sent', 'acks', 'commands_per_second', 'bytes_per_second', 'starvation_events',
+	'heating_seconds', 'commands_in_flight', 'file_queue_depth', 'credit_recoveries')
+
+def cores():
+	try:
+		return len(os.sched_getaffinity(0))
+	except AttributeError:
+		return os.cpu_count() or 1
+
+def deal(machines, workers):
+	""" round robin, so machines listed together don't end up on the same core """
+	workers = max(1, min(workers or cores(), len(machines)))
+	return [machines[i::workers] for i in range(workers)]
+
+class Worker:
+	def __init__(self, index, machines):
+		self.index = index
+		self.machines = machines
+		self.process = None
+		# machine name -> last metrics snapshot
+		self.health = {}
+
+	def __str__(self):
+		return f"<Worker {self.index}: pid {self.pid}, {', '.join(m.name for m in self.machines)}>"
+
+	@property
+	def pid(self):
+		return None if self.process is None else self.process.pid
+
+	def summary(self):
+		state = 'running' if self.process.is_alive() else f"exited ({self.process.exitcode})"
+		return {
+			'worker': self.index,
+			'pid': self.pid,
+			'state': state,
+			'machines': {m.name: m.tcp_port for m in self.machines},
+			'reporting': len(self.health),
+			**add_up(self.health.values()),
+		}
+
+def add_up(snapshots):
+	total = dict.fromkeys(SUMMED, 0)
+	for snapshot in snapshots:
+		for key in SUMMED:
+			total[key] += snapshot.get(key) or 0
+	return total
+
+
+class Supervisor:
+	"""
+		forks the workers, routes TCP commands to the machines and aggregates
+		their health ; `run(target)` returns when every worker has exited
+
+		`target(machines)` is what a worker runs (in the child process).
+	"""
+	def __init__(self, machines, workers = None, port = 6999):
+		self.machines = {m.name: m for m in machines}
+		self.workers = [Worker(i, share) for i, share in enumerate(deal(machines, workers))]
+		self.owner = {m.name: w for w in self.workers for m in w.machines}
+		self.port = port
+
+	def __str__(self):
+		return f"<Supervisor: {len(self.machines)} machines on {len(self.workers)} workers, TCP {self.port}>"
+
+	def start(self, target):
+		context = multiprocessing.get_context('fork')
+		for w in self.workers:
+			w.process = context.Process(target=target, args=(w.machines,), name=f"gp worker {w.index}", daemon=True)
+			w.process.start()
+			logger.info(f"started {w}")
+
+	def stop(self):
+		for w in self.workers:
+			if w.process.is_alive():
+				w.process.terminate()
+
+	async def run(self, target):
+		self.start(target)
+		loop = asyncio.get_running_loop()
+		for signum in (signal.SIGTERM, signal.SIGINT):
+			loop.add_signal_handler(signum, self.stop)
+		server = await asyncio.start_server(self.handle, '0.0.0.0', self.port)
+		logger.info(f"{self} listening")
+		watch = asyncio.create_task(self.watch())
+		try:
+			# a worker exits when all its machines are lost
+			await asyncio.gather(*(loop.run_in_executor(None, w.process.join) for w in self.workers))
+		finally:
+			watch.cancel()
+			server.close()
+		return [w.process.exitcode for w in self.workers]
+
+	async def watch(self):
+		""" background task: collects the metrics of every machine """
+		connections = {}
+		while True:
+			await asyncio.sleep(HEALTH_INTERVAL)
+			for w in self.workers:
+				if not w.process.is_alive():
+					if w.health:
+						logger.error(f"worker {w.index} exited ({w.process.exitcode}): {', '.join(w.health)}")
+					w.health.clear()
+					continue
+				for m in w.machines:
+					try:
+						if m.name not in connections:
+							connections[m.name] = await asyncio.open_connection('localhost', m.tcp_port)
+						reader, writer = connections[m.name]
+						writer.write(b'metrics\n')
+						w.health[m.name] = json.loads(await asyncio.wait_for(reader.readline(), HEALTH_INTERVAL))
+					except (OSError, ValueError, asyncio.TimeoutError) as e:
+						logger.info(f"no metrics from {m.name}: {e!r}")
+						if (connection := connections.pop(m.name, None)) is not None:
+							connection[1].close()
+						w.health.pop(m.name, None)
+
+	async def handle(self, reader, writer):
+		""" one client of the supervisor port """
+		peer, _ = writer.get_extra_info("peername")
+		logger.info(f"supervisor: new client connection from {peer}")
+		# machine name -> connection to its TCP port, opened on first use
+		upstream = {}
+		pumps = []
+
+		async def pump(name, machine_reader):
+			# what the machine answers goes back to the client
+			while line := await machine_reader.readline():
+				writer.write(name.encode()+b': '+line)
+
+		async def route(name, command):
+			if name not in upstream:
+				r, w = await asyncio.open_connection('localhost', self.machines[name].tcp_port)
+				upstream[name] = w
+				pumps.append(asyncio.create_task(pump(name, r)))
+			upstream[name].write(command)
+
+		try:
+			while data := await reader.readline():
+				name, _, command = data.partition(b' ')
+				name = name.strip().decode(errors='replace')
+				if name == 'workers':
+					for w in self.workers:
+						writer.write(json.dumps(w.summary()).encode()+b'\n')
+				elif name == 'metrics':
+					writer.write(json.dumps({'workers': len(self.workers), 'machines': len(self.machines),
+						**add_up(s for w in self.workers for s in w.health.values())}).encode()+b'\n')
+				elif name == 'all' and command:
+					for name in self.machines:
+						try:
+							await route(name, command)
+						except OSError as e:
+							writer.write(f"{name}: unreachable ({e})\n".encode())
+				elif name in self.machines and command:
+					try:
+						await route(name, command)
+					except OSError as e:
+						writer.write(f"{name}: unreachable ({e})\n".encode())
+				elif name:
+					writer.write(f"usage: <machine>|all <command>, workers or metrics ; machines: {', '.join(self.machines)}\n".encode())
+		finally:
+			for task in pumps:
+				task.cancel()
+			for w in upstream.values():
+				w.close()
+			writer.close()
+			logger.info(f"supervisor: client {peer} disconnected")
@@ -1,9 +1,17 @@
 #!/usr/bin/env python
+import asyncio
+import json
+import os
 import socket
-from time import sleep
+from collections import deque
+from time import sleep, monotonic
 from threading import Thread
 
 host, port = 'killerwhale', 7000
+# --stream: commands in flight (sent and not acknowledged), commands per request
+STREAM_WINDOW = 256
+STREAM_BATCH = 32
+RECONNECT_DELAY = 1
 
 clientsocket = []
 
@@ -33,18 +41,167 @@ class InteractiveMacro:
 
 "G29 L-50 R130 F-140 B-50"
 
+# G-Code macros are in the machine config and run by gp (ie. `@init`, `@babystep .25`, see macros.py)
 macros = {
-    'init': b"""M104 S120
-        M140 S60
-        G34
-        M420 S1""",
-    '+0.25mm babystepping': b'M290 Z.25',
-    '-0.25mm babystepping': b'M290 Z-.25',
     #'resume_on_crash': InteractiveMacro("""resume_on_crash;Z={};L={};B={}\n""", ('Z','L','B'))
     'resume_on_crash': InteractiveMacro("""resume_on_crash;{}\n""", ('L,P',))
 }
 
+class Streamer:
+    """
+        streams a G-Code file (or stdin) to gp over its JSON lines protocol
+
+        up to `window` commands are in flight, sent `batch` at a time ; every
+        command has a sequence number and is kept until gp reports it
+        acknowledged by the machine. When the connection is lost, the client
+        reconnects and sends again what wasn't acknowledged (gp skips what it
+        had already received).
+    """
+    def __init__(self, source, window = STREAM_WINDOW, batch = STREAM_BATCH, name = None, go = False):
+        self.source = source
+        self.window = window
+        self.batch = batch
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}:{getattr(source, 'name', 'stdin')}"
+        self.go = go
+        # (seq, command) not acknowledged yet, oldest first
+        self.unacked = deque()
+        self.next_seq = 0
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        self.eof = False
+        self.connections = 0
+        self.progress = None
+        self.started = monotonic()
+
+    def __str__(self):
+        return f"<Streamer: {self.name}, {self.next_seq} read, {self.acked} acked, {len(self.unacked)} in flight, {self.errors} errors>"
+
+    def read(self, n):
+        """ up to `n` commands, comments and blank lines are skipped (in a thread, stdin may block) """
+        from gcode_compile import compile_line
+        commands = []
+        while len(commands) < n:
+            line = self.source.readline()
+            if not line:
+                self.eof = True
+                break
+            if (compiled := compile_line(line)) is not None:
+                commands.append(compiled[0].decode().rstrip('\n'))
+        return commands
+
+    async def run(self, host, port):
+        loop = asyncio.get_running_loop()
+        reporter = asyncio.create_task(self.report())
+        try:
+            while not self.eof or self.unacked:
+                try:
+                    reader, writer = await asyncio.open_connection(host, port)
+                except OSError:
+                    print(".", end='', flush=True)
+                    await asyncio.sleep(RECONNECT_DELAY)
+                    continue
+                self.connections += 1
+                print(f"\nconnected to {host}:{port} ({self.connections})")
+                self.progress = asyncio.Event()
+                results = asyncio.create_task(self.results(reader))
+                try:
+                    if self.go:
+                        writer.write(b'{"op":"go"}\n')
+                    # what wasn't acknowledged on the connection that was lost
+                    pending = list(self.unacked)
+                    while not (self.eof and not pending) or self.unacked:
+                        if results.done():
+                            raise ConnectionResetError("connection closed by gp")
+                        if pending:
+                            chunk, pending = pending[:self.batch], pending[self.batch:]
+                        elif not self.eof and len(self.unacked) < self.window:
+                            commands = await loop.run_in_executor(None, self.read, min(self.batch, self.window-len(self.unacked)))
+                            chunk = [(self.next_seq+i, cmd) for i, cmd in enumerate(commands)]
+                            self.next_seq += len(chunk)
+                            self.unacked.extend(chunk)
+                        else:
+                            # the window is full (or everything was sent): wait for results
+                            self.progress.clear()
+                            progress = asyncio.ensure_future(self.progress.wait())
+                            await asyncio.wait((progress, results), return_when=asyncio.FIRST_COMPLETED)
+                            progress.cancel()
+                            continue
+                        if chunk:
+                            writer.write(json.dumps({'op': 'send', 'stream': self.name, 'seq': chunk[0][0],
+                                'commands': [cmd for _, cmd in chunk]}).encode()+b'\n')
+                            self.sent += len(chunk)
+                            await writer.drain()
+                except (ConnectionError, OSError) as e:
+                    print(f"\nconnection lost ({e}), {len(self.unacked)} commands to send again")
+                    await asyncio.sleep(RECONNECT_DELAY)
+                finally:
+                    results.cancel()
+                    writer.close()
+        finally:
+            reporter.cancel()
+        self.print_rates()
+
+    async def results(self, reader):
+        """ what gp answers ; returns when the connection is closed """
+        while line := await reader.readline():
+            result = json.loads(line)
+            if 'seq' in result:
+                if not result['ok']:
+                    self.errors += 1
+                    print(f"\n{result['seq']}: {result['command']}: {' / '.join(result['replies'])}")
+                seq = result['seq']
+            elif 'acked_through' in result:
+                # after a reconnection: the results that went to the connection that was lost
+                seq = result['acked_through']
+            else:
+                if 'error' in result:
+                    print(f"\nerror: {result['error']}")
+                continue
+            # results come in order, the oldest commands are acknowledged first
+            while self.unacked and self.unacked[0][0] <= seq:
+                self.unacked.popleft()
+            self.acked = self.unacked[0][0] if self.unacked else self.next_seq
+            self.progress.set()
+
+    def print_rates(self, end = '\n'):
+        elapsed = monotonic()-self.started
+        print(f"\rsent {self.sent} ({self.sent/elapsed:.0f}/s) acked {self.acked} ({self.acked/elapsed:.0f}/s) in flight {len(self.unacked)} errors {self.errors}   ", end=end, flush=True)
+
+    async def report(self):
+        self.started = monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self.print_rates(end='')
+
+
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="tcp_client",
+        description="sends commands (and macros) to gp over TCP, or streams a whole G-Code file with --stream",
+    )
+    parser.add_argument("--host", default = host, help=f"gp host ({host})", metavar="str")
+    parser.add_argument("--port", default = port, type=int, help=f"gp TCP port ({port})", metavar="int")
+    parser.add_argument("-s", "--stream", default = None, help="stream this G-Code file ('-' for stdin) and quit once every command is acknowledged", metavar="file")
+    parser.add_argument("--window", default = STREAM_WINDOW, type=int, help=f"commands in flight with --stream ({STREAM_WINDOW})", metavar="int")
+    parser.add_argument("--batch", default = STREAM_BATCH, type=int, help=f"commands per request with --stream ({STREAM_BATCH})", metavar="int")
+    parser.add_argument("--name", default = None, help="name of the stream, to resume it from another client (host:pid:file)", metavar="str")
+    parser.add_argument("--go", action='store_true', help="send `go` first, gp doesn't send file commands before")
+    args = parser.parse_args()
+    host, port = args.host, args.port
+
+    if args.stream is not None:
+        from sys import stdin
+        source = stdin.buffer if args.stream == '-' else open(args.stream, 'rb')
+        streamer = Streamer(source, args.window, args.batch, args.name, args.go)
+        try:
+            asyncio.run(streamer.run(host, port))
+        except KeyboardInterrupt:
+            print(f"\ninterrupted: {streamer}")
+        exit(1 if streamer.errors else 0)
+
     while True:
         try:
             clientsocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
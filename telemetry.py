@@ -0,0 +1,138 @@
+import asyncio
+import struct
+from sys import stdout
+import logging
+from time import monotonic
+
+logger = logging.getLogger('stderrLogger')
+
+# time, kind, P, B, free credits, line number (or queue length), data (truncated)
+RECORD = struct.Struct('<dBxhhhi48s')
+
+# kinds
+SENT, TCP, REPLY, TEMP, PING, EVENT = range(6)
+KINDS = ('sent', 'tcp', 'reply', 'temp', 'ping', 'event')
+
+# verbosity levels, each includes the ones before
+QUIET = 0	# nothing
+EVENTS = 1	# events (print start/stop, resumes, ...) and machine replies
+STATUS = 2	# + temperature reports and periodic status
+COMMANDS = 3	# + every command sent (or one in `sample`)
+LEVELS = {'quiet': QUIET, 'events': EVENTS, 'status': STATUS, 'commands': COMMANDS}
+
+DRAIN_INTERVAL = .25
+# a TCP subscriber that doesn't keep up loses records instead of slowing everybody down
+SUBSCRIBER_HIGH_WATER = 256*1024
+
+class Telemetry:
+	"""
+		structured, low-overhead replacement for print() on the send path
+
+		records are packed into a preallocated ring of fixed-size slots
+		(`RECORD`) ; nothing is formatted and nothing blocks when recording.
+		`drain()` runs in the background and formats whatever was recorded
+		every DRAIN_INTERVAL into text lines for a file (stdout by default) and
+		for TCP subscribers (see the `telemetry` command in gp). When the ring
+		is full the oldest records are overwritten (and counted as dropped).
+	"""
+	def __init__(self, capacity = 4096, level = COMMANDS, sample = 1, out = stdout, name = None):
+		self.capacity = capacity
+		# prefix of every line, tells machines apart when several write to the same output
+		self.prefix = '' if name is None else f"{name}\t"
+
+		self.ring = bytearray(capacity*RECORD.size)
+		# total number of records written and read, the ring index is modulo capacity
+		self.head = self.tail = 0
+		self.dropped = 0
+		self.level = level
+		self.sample = max(1, sample)
+		self._sample_count = 0
+		# None: subscribers only
+		self.out = out
+		self.subscribers = set()
+
+	def __str__(self):
+		return f"<Telemetry: level {self.level}, 1/{self.sample} commands, {self.head-self.tail}/{self.capacity} pending, {self.dropped} dropped, {len(self.subscribers)} subscribers>"
+
+	def record(self, kind, P = None, B = None, free = 0, n = -1, data = b''):
+		""" P and B are None when unknown ; `data` is bytes and gets truncated to 48 bytes """
+		RECORD.pack_into(self.ring, (self.head % self.capacity)*RECORD.size,
+			monotonic(), kind, -1 if P is None else P, -1 if B is None else B, free, n, data)
+		self.head += 1
+
+	def command(self, kind, n, cmd, P, B, free):
+		""" a command was sent (the hot path: cheap when filtered out) """
+		if self.level < COMMANDS:
+			return
+		self._sample_count += 1
+		if self._sample_count < self.sample:
+			return
+		self._sample_count = 0
+		# n is None before the first line of a file (resume preamble, remote files)
+		self.record(kind, P, B, free, -1 if n is None else n, cmd)
+
+	def status(self, P, B, free, n, data = b''):
+		if self.level >= STATUS:
+			self.record(PING, P, B, free, n, data)
+
+	def temperature(self, reply):
+		if self.level >= STATUS:
+			self.record(TEMP, data=reply)
+
+	def reply(self, reply):
+		if self.level >= EVENTS:
+			self.record(REPLY, data=reply)
+
+	def event(self, message):
+		if self.level >= EVENTS:
+			self.record(EVENT, data=message.encode(errors='replace'))
+
+	def subscribe(self, writer):
+		""" sends the telemetry stream to a TCP client (asyncio.StreamWriter) until it disconnects """
+		self.subscribers.add(writer)
+
+	def _format(self, t, kind, P, B, free, n, data):
+		text = data.rstrip(b'\0').rstrip().decode(errors='replace')
+		if kind in (SENT, TCP):
+			return f"{self.prefix}{t:.3f}\t{KINDS[kind]}\tP:{P}\tB:{B}\tB':{free}\tN:{n}\t{text}\n"
+		if kind == PING:
+			return f"{self.prefix}{t:.3f}\t{KINDS[kind]}\tP:{P}\tB:{B}\tin flight:{free}\tqueued:{n}\t{text}\n"
+		return f"{self.prefix}{t:.3f}\t{KINDS[kind]}\t{text}\n"
+
+	def pop_lines(self):
+		""" formats and forgets everything that was recorded so far """
+		if self.head-self.tail > self.capacity:
+			self.dropped += self.head-self.tail-self.capacity
+			self.tail = self.head-self.capacity
+		lines = []
+		while self.tail < self.head:
+			lines.append(self._format(*RECORD.unpack_from(self.ring, (self.tail % self.capacity)*RECORD.size)))
+			self.tail += 1
+		return ''.join(lines)
+
+	async def drain(self):
+		""" background task: writes the records to the output file and to the subscribers """
+		loop = asyncio.get_running_loop()
+		while True:
+			await asyncio.sleep(DRAIN_INTERVAL)
+			if self.head == self.tail:
+				continue
+			text = self.pop_lines()
+			if self.out is not None:
+				# a slow console blocks a worker thread, not the event loop
+				await loop.run_in_executor(None, self._write, text)
+			for writer in list(self.subscribers):
+				if writer.is_closing():
+					self.subscribers.discard(writer)
+				elif writer.transport.get_write_buffer_size() < SUBSCRIBER_HIGH_WATER:
+					writer.write(text.encode())
+				else:
+					self.dropped += text.count('\n')
+
+	def _write(self, text):
+		try:
+			self.out.write(text)
+			self.out.flush()
+		except OSError as e:
+			logger.error(f"telemetry output failed, disabled: {e}")
+			self.out = None
@@ -0,0 +1,28 @@
+from time import sleep
+
+from gcode_source import MappedLines
+from interleave import ZInterleaver
+
+def interleave(tmp_path, files):
+	piles = {}
+	for name, text in files.items():
+		path = tmp_path/name
+		path.write_text(text)
+		piles[name] = MappedLines(str(path))
+	interleaver = ZInterleaver(piles)
+	while not interleaver.ready:
+		sleep(.01)
+	sent = []
+	while len(interleaver):
+		sent.append(interleaver.pop(0))
+	return sent
+
+def test_first_layer_without_z(tmp_path):
+	""" a file that extrudes before any Z move is interleaved with one that has Z """
+	sent = interleave(tmp_path, {
+		'a.gcode': "G1 Z0.2\nG1 X1 E1\nG1 Z0.4\nG1 X2 E2\n",
+		'b.gcode': "M83\nG1 X5 E1\nG1 Z0.4\nG1 X6 E1\n",
+	})
+	assert b'G1 X5 E1' in sent and b'G1 X2 E2' in sent
+	# b's first layer has no Z, it is printed first
+	assert sent.index(b'G1 X5 E1') < sent.index(b'G1 X1 E1')